@@ -25,6 +25,10 @@
 #   NO_FORMAT_CODE:  Optional, do not run format-code.sh
 #   EXTRA_DOCKER_RUN_ARGS:  Optional, pass arguments to docker run
 #   EXTRA_UNIT_TEST_ARGS:  Optional, pass arguments to unit-test.py
+#   UNIT_TEST_CACHE_DIR: Optional, host directory mounted into the container
+#                    to keep the compiler cache and the other unit test
+#                    caches in between runs. default is .unit-test-cache in
+#                    the WORKSPACE
 #   INTERACTIVE: Optional, run a bash shell instead of unit-test.py
 #   http_proxy: Optional, run the container with proxy environment
 
@@ -43,6 +47,7 @@ DBUS_SYS_CONFIG_FILE=${dbus_sys_config_file:-"/usr/share/dbus-1/system.conf"}
 MAKEFLAGS="${MAKEFLAGS:-""}"
 NO_FORMAT_CODE="${NO_FORMAT_CODE:-}"
 INTERACTIVE="${INTERACTIVE:-}"
+UNIT_TEST_CACHE_DIR="${UNIT_TEST_CACHE_DIR:-}"
 http_proxy=${http_proxy:-}
 
 # Timestamp for job
@@ -73,7 +78,7 @@ export DOCKER_IMG_NAME
 
 # Allow the user to pass options through to unit-test.py:
 #   EXTRA_UNIT_TEST_ARGS="-r 100" ...
-EXTRA_UNIT_TEST_ARGS="${EXTRA_UNIT_TEST_ARGS:+,${EXTRA_UNIT_TEST_ARGS/ /,}}"
+EXTRA_UNIT_TEST_ARGS="${EXTRA_UNIT_TEST_ARGS:+,${EXTRA_UNIT_TEST_ARGS// /,}}"
 
 # Unit test and parameters
 if [ "${INTERACTIVE}" ]; then
@@ -82,6 +87,7 @@ else
     UNIT_TEST="${UNIT_TEST_SCRIPT_DIR}/${UNIT_TEST_PY},-w,${DOCKER_WORKDIR},\
 -p,${UNIT_TEST_PKG},-b,$BRANCH,\
 -v${TEST_ONLY:+,-t}${NO_FORMAT_CODE:+,-n}\
+${UNIT_TEST_CACHE_DIR:+,--cache-dir,${UNIT_TEST_CACHE_DIR}}\
 ${EXTRA_UNIT_TEST_ARGS}"
 fi
 
@@ -100,6 +106,13 @@ if [ -n "${http_proxy}" ]; then
         --env ftp_proxy=${http_proxy}"
 fi
 
+# Mount the cache directory at the same path in the container
+CACHE_MOUNT=()
+if [ -n "${UNIT_TEST_CACHE_DIR}" ]; then
+    mkdir -p "${UNIT_TEST_CACHE_DIR}"
+    CACHE_MOUNT=(-v "${UNIT_TEST_CACHE_DIR}:${UNIT_TEST_CACHE_DIR}")
+fi
+
 # If we are building on a podman based machine, need to have this set in
 # the env to allow the home mount to work (no impact on non-podman systems)
 export PODMAN_USERNS="keep-id"
@@ -111,6 +124,7 @@ docker run --cap-add=sys_admin --rm=true \
     ${PROXY_ENV} \
     -u "$USER" \
     -w "${DOCKER_WORKDIR}" -v "${WORKSPACE}":"${DOCKER_WORKDIR}" \
+    "${CACHE_MOUNT[@]}" \
     -e "MAKEFLAGS=${MAKEFLAGS}" \
     ${EXTRA_DOCKER_RUN_ARGS:-} \
     -${INTERACTIVE:+i}t "${DOCKER_IMG_NAME}" \
@@ -0,0 +1,145 @@
+#!/usr/bin/env python3
+
+"""
+Benchmarks unit-test.py's dependency graph on random DAGs: one ordering
+constraint followed by the generation of the install list. Optionally
+times the DepTree of an older unit-test.py on the same graphs, e.g. one
+extracted with `git show <commit>:scripts/unit-test.py > old-unit-test.py`,
+and checks that both yield the same unconstrained install order.
+"""
+
+import argparse
+import importlib.util
+import os
+import random
+import sys
+import time
+
+# Every fifth package matches the regex, like the dbus interface packages
+REGEX = r"\S+-dbus-interfaces$"
+
+
+def load(path, name):
+    """
+    Loads a unit-test.py as a module.
+
+    Parameter descriptions:
+    path                Path of the script
+    name                Name to give the module
+    """
+    spec = importlib.util.spec_from_file_location(name, path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def synthesize(count, seed):
+    """
+    Returns the names of the packages of a random DAG with an out-degree of
+    three, the first package depending on every otherwise unrequired one,
+    and the dict of their dependencies.
+
+    Parameter descriptions:
+    count               Number of packages
+    seed                Seed of the random generator
+    """
+    rng = random.Random(seed)
+    names = [
+        f"x{i}-dbus-interfaces" if i % 5 == 0 else f"pkg{i}"
+        for i in range(count)
+    ]
+    deps = {
+        name: (
+            [names[j] for j in rng.sample(range(i + 1, count), 3)]
+            if count - i > 3
+            else names[i + 1 :]
+        )
+        for i, name in enumerate(names)
+    }
+    required = {dep for dep_list in deps.values() for dep in dep_list}
+    deps[names[0]] += [name for name in names[1:] if name not in required]
+    return names, deps
+
+
+def build_graph(module, names, deps):
+    graph = module.DepGraph(names[0])
+    for name in names:
+        for dep in deps[name]:
+            graph.AddEdge(name, dep)
+    return graph
+
+
+def build_tree(module, names, deps):
+    # DepTree records the first parent found depth-first from the root
+    root = module.DepTree(names[0])
+    added = {names[0]}
+    stack = [(names[0], root, iter(deps[names[0]]))]
+    while stack:
+        name, node, children = stack[-1]
+        for dep in children:
+            if dep not in added:
+                added.add(dep)
+                child = node.AddChild(dep)
+                stack.append((dep, child, iter(deps[dep])))
+                break
+        else:
+            stack.pop()
+    return root
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "--sizes",
+        type=int,
+        nargs="+",
+        default=[1000, 3000, 10000],
+        help="Numbers of packages of the graphs",
+    )
+    parser.add_argument(
+        "--seed", type=int, default=1, help="Seed of the random graphs"
+    )
+    parser.add_argument(
+        "--compare",
+        help="Path of an older unit-test.py whose DepTree to time as well",
+    )
+    args = parser.parse_args()
+
+    here = os.path.dirname(os.path.abspath(__file__))
+    current = load(os.path.join(here, "unit-test.py"), "unit_test")
+    old = load(args.compare, "old_unit_test") if args.compare else None
+    # DepTree recurses once per level of the tree
+    sys.setrecursionlimit(max(sys.getrecursionlimit(), 10 * max(args.sizes)))
+
+    print(f"{'packages':>10} {'DepTree':>10} {'DepGraph':>10}")
+    for count in args.sizes:
+        names, deps = synthesize(count, args.seed)
+        graph = build_graph(current, names, deps)
+        install_list = graph.GetInstallList()
+        # Constrain a package early in the install order
+        target = [n for n in install_list if n.startswith("pkg")][count // 4]
+
+        start = time.perf_counter()
+        graph.AddOrderingConstraint(target, REGEX)
+        constrained = graph.GetInstallList()
+        graph_time = time.perf_counter() - start
+        position = {name: i for i, name in enumerate(constrained)}
+        for name, name_deps in graph.nodes.items():
+            for dep in name_deps:
+                if position[dep] > position[name]:
+                    raise Exception(f"{name} is installed before {dep}")
+
+        tree_time = "-"
+        if old:
+            tree = build_tree(old, names, deps)
+            if tree.GetInstallList() != install_list:
+                raise Exception("DepTree and DepGraph install orders differ")
+            start = time.perf_counter()
+            tree.ReorderDeps(target, REGEX)
+            tree.GetInstallList()
+            tree_time = f"{time.perf_counter() - start:.3f}s"
+        print(f"{count:>10} {tree_time:>10} {graph_time:>9.3f}s")
+
+
+if __name__ == "__main__":
+    main()
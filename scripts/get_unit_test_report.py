@@ -27,6 +27,7 @@
 # target_dir.
 
 import argparse
+import json
 import logging
 import os
 import re
@@ -243,17 +244,10 @@ logger.debug(url_info)
 repo_count = len(url_info)
 logger.info("Number of repositories (Including archived): " + str(repo_count))
 
-# Clone repository and run unit test.
-coverage_report = []
-counter = 0
-tested_report_count = 0
-coverage_count = 0
-unit_test_count = 0
-no_report_count = 0
-error_count = 0
-skip_count = 0
-archive_count = 0
+# Clone the repositories to unit test.
 url_list = sorted(url_info)
+sandbox_names = {}
+ut_statuses = {}
 for url in url_list:
     ut_status = "NO"
     skip = False
@@ -292,26 +286,66 @@ for url in url_list:
                 ut_status = "ERROR"
                 skip = True
     if not (skip):
-        docker_cmd = (
-            "WORKSPACE=$(pwd) UNIT_TEST_PKG="
-            + sandbox_name
-            + " "
-            + "./openbmc-build-scripts/run-unit-test-docker.sh"
+        sandbox_names[url] = sandbox_name
+    ut_statuses[url] = ut_status
+
+# Run the unit tests of all the repositories in a single container, which
+# installs the dependencies they share once.
+batch_results = {}
+batch_report = os.path.join(working_dir, "unit-test-report.json")
+if sandbox_names:
+    tested = [sandbox_names[url] for url in url_list if url in sandbox_names]
+    # A run dying before writing its report mustn't pass off an earlier one
+    if os.path.exists(batch_report):
+        os.remove(batch_report)
+    docker_cmd = (
+        "WORKSPACE=$(pwd) UNIT_TEST_PKG="
+        + tested[0]
+        + " EXTRA_UNIT_TEST_ARGS='--packages "
+        + " ".join(tested)
+        + "' ./openbmc-build-scripts/run-unit-test-docker.sh"
+    )
+    try:
+        result = subprocess.check_output(
+            docker_cmd,
+            cwd=working_dir,
+            shell=True,
+            stderr=subprocess.STDOUT,
         )
-        try:
-            result = subprocess.check_output(
-                docker_cmd,
-                cwd=working_dir,
-                shell=True,
-                stderr=subprocess.STDOUT,
-            )
-            logger.debug(result)
-            logger.debug("UT BUILD COMPLETED FOR: " + sandbox_name)
+        logger.debug(result)
+        logger.debug("UT BUILD COMPLETED")
+    except subprocess.CalledProcessError as e:
+        logger.debug(e.output)
+        logger.debug(e.cmd)
+        logger.debug("UT BUILD EXITED")
+    try:
+        with open(batch_report) as f:
+            batch_results = json.load(f)["packages"]
+    except (IOError, ValueError, KeyError) as e:
+        logger.error("Unable to read the unit test report: " + str(e))
 
-        except subprocess.CalledProcessError as e:
-            logger.debug(e.output)
-            logger.debug(e.cmd)
+# Collect the unit test reports.
+coverage_report = []
+counter = 0
+tested_report_count = 0
+coverage_count = 0
+unit_test_count = 0
+no_report_count = 0
+error_count = 0
+skip_count = 0
+archive_count = 0
+for url in url_list:
+    if url not in ut_statuses:
+        continue
+    ut_status = ut_statuses[url]
+    if url in sandbox_names:
+        sandbox_name = sandbox_names[url]
+        batch_result = batch_results.get(sandbox_name, {})
+        if batch_result.get("result") in ("passed", "skipped"):
+            logger.debug("UT BUILD COMPLETED FOR: " + sandbox_name)
+        else:
             logger.debug("UT BUILD EXITED FOR: " + sandbox_name)
+            logger.debug(batch_result.get("error"))
             ut_status = "ERROR"
 
         folder_name = os.path.join(working_dir, sandbox_name)
@@ -0,0 +1,211 @@
+#!/usr/bin/env python3
+
+"""
+Tests of unit-test.py's cache of meson wrap subprojects, with a local HTTP
+server and local git repositories standing in for upstream.
+"""
+
+import functools
+import hashlib
+import http.server
+import importlib.util
+import os
+import subprocess
+import tarfile
+import tempfile
+import threading
+import unittest
+
+SCRIPT = os.path.join(os.path.dirname(__file__), os.pardir, "unit-test.py")
+
+
+def load_unit_test():
+    spec = importlib.util.spec_from_file_location("unit_test", SCRIPT)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    # Globals which unit-test.py sets up from its arguments
+    module.printline = lambda *line: None
+    module.TRACER = module.Tracer(None)
+    module.JOBSERVER = None
+    module.OFFLINE = False
+    return module
+
+
+def git(*args, cwd):
+    return subprocess.check_output(
+        ["git", *args],
+        cwd=cwd,
+        env=dict(
+            os.environ,
+            GIT_AUTHOR_NAME="test",
+            GIT_AUTHOR_EMAIL="test@example.com",
+            GIT_COMMITTER_NAME="test",
+            GIT_COMMITTER_EMAIL="test@example.com",
+        ),
+    ).decode("utf-8")
+
+
+class Upstream:
+    """
+    Serves a source archive over HTTP and hosts a git repository.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.requests = []
+        os.makedirs(os.path.join(path, "files"))
+
+        sources = os.path.join(path, "foo-1.0")
+        os.mkdir(sources)
+        with open(os.path.join(sources, "meson.build"), "w") as f:
+            f.write("project('foo')\n")
+        self.archive = os.path.join(path, "files", "foo-1.0.tar.gz")
+        with tarfile.open(self.archive, "w:gz") as tar:
+            tar.add(sources, "foo-1.0")
+        with open(self.archive, "rb") as f:
+            self.archive_hash = hashlib.sha256(f.read()).hexdigest()
+
+        self.repo = os.path.join(path, "bar")
+        os.mkdir(self.repo)
+        with open(os.path.join(self.repo, "meson.build"), "w") as f:
+            f.write("project('bar')\n")
+        git("init", "-q", "-b", "main", cwd=self.repo)
+        git("add", "meson.build", cwd=self.repo)
+        git("commit", "-q", "-m", "bar", cwd=self.repo)
+        self.revision = git("rev-parse", "HEAD", cwd=self.repo).strip()
+
+        requests = self.requests
+
+        class Handler(http.server.SimpleHTTPRequestHandler):
+            def log_message(self, *args):
+                requests.append(self.path)
+
+        self.server = http.server.ThreadingHTTPServer(
+            ("127.0.0.1", 0),
+            functools.partial(Handler, directory=os.path.join(path, "files")),
+        )
+        self.url = "http://127.0.0.1:{}".format(self.server.server_port)
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.start()
+
+    def close(self):
+        if not self.thread.is_alive():
+            return
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
+
+    def file_wrap(self):
+        return (
+            "[wrap-file]\n"
+            "directory = foo-1.0\n"
+            f"source_url = {self.url}/foo-1.0.tar.gz\n"
+            "source_filename = foo-1.0.tar.gz\n"
+            f"source_hash = {self.archive_hash}\n"
+        )
+
+    def git_wrap(self, revision):
+        return f"[wrap-git]\nurl = {self.repo}\nrevision = {revision}\n"
+
+
+class WrapCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.ut = load_unit_test()
+        self.temp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.temp.cleanup)
+        self.upstream = Upstream(os.path.join(self.temp.name, "upstream"))
+        self.addCleanup(self.upstream.close)
+        self.cache_dir = os.path.join(self.temp.name, "cache")
+        self.ut.LOGS = self.ut.LogCapture(
+            os.path.join(self.temp.name, "logs"), 0
+        )
+
+    def project(self, wraps, used):
+        """
+        Creates a project with the given wrap files, using the subprojects
+        named in used.
+        """
+        path = tempfile.mkdtemp(dir=self.temp.name)
+        os.mkdir(os.path.join(path, "subprojects"))
+        with open(os.path.join(path, "meson.build"), "w") as f:
+            f.write("project('test')\n")
+            for name in used:
+                f.write(f"subproject('{name}')\n")
+        for name, contents in wraps.items():
+            wrap = os.path.join(path, "subprojects", name + ".wrap")
+            with open(wrap, "w") as f:
+                f.write(contents)
+        return path
+
+    def setup(self, path, offline=False):
+        self.ut.OFFLINE = offline
+        self.ut.WRAP_CACHE = self.ut.WrapCache(self.cache_dir, offline)
+        self.ut.Meson("test", path)._setup(os.path.join(path, "build"), [path])
+
+    def cached(self, contents):
+        return os.path.isdir(
+            self.ut.WRAP_CACHE._entry(contents.encode("utf-8"))
+        )
+
+    def test_resolved_wraps_are_cached(self):
+        wraps = {
+            "foo": self.upstream.file_wrap(),
+            "bar": self.upstream.git_wrap(self.upstream.revision),
+        }
+        self.setup(self.project(wraps, ["foo", "bar"]))
+        self.assertTrue(self.cached(wraps["foo"]))
+        self.assertTrue(self.cached(wraps["bar"]))
+
+    def test_cache_hit_skips_download(self):
+        wraps = {"foo": self.upstream.file_wrap()}
+        self.setup(self.project(wraps, ["foo"]))
+        downloads = len(self.upstream.requests)
+        self.assertGreater(downloads, 0)
+        path = self.project(wraps, ["foo"])
+        self.setup(path)
+        self.assertEqual(len(self.upstream.requests), downloads)
+        self.assertTrue(
+            os.path.isfile(
+                os.path.join(path, "subprojects", "foo-1.0", "meson.build")
+            )
+        )
+
+    def test_unused_wraps_are_not_downloaded(self):
+        wraps = {
+            "foo": self.upstream.file_wrap(),
+            "missing": self.upstream.file_wrap().replace(
+                "foo-1.0.tar.gz", "missing.tar.gz"
+            ),
+        }
+        self.setup(self.project(wraps, []))
+        self.assertEqual(self.upstream.requests, [])
+        self.assertFalse(self.cached(wraps["foo"]))
+
+    def test_unpinned_git_wraps_are_not_cached(self):
+        wraps = {"bar": self.upstream.git_wrap("main")}
+        path = self.project(wraps, ["bar"])
+        self.setup(path)
+        self.assertTrue(
+            os.path.isdir(os.path.join(path, "subprojects", "bar"))
+        )
+        self.assertFalse(self.cached(wraps["bar"]))
+
+    def test_offline_uses_cache(self):
+        wraps = {
+            "foo": self.upstream.file_wrap(),
+            "bar": self.upstream.git_wrap(self.upstream.revision),
+        }
+        self.setup(self.project(wraps, ["foo", "bar"]))
+        # Nothing may be fetched from upstream anymore
+        self.upstream.close()
+        self.setup(self.project(wraps, ["foo", "bar"]), offline=True)
+
+    def test_offline_miss_fails(self):
+        wraps = {"foo": self.upstream.file_wrap()}
+        with self.assertRaises(subprocess.CalledProcessError):
+            self.setup(self.project(wraps, ["foo"]), offline=True)
+        self.assertEqual(self.upstream.requests, [])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -8,224 +8,531 @@ prior to executing its unit tests.
 """
 
 import argparse
+import atexit
+import collections
+import concurrent.futures
+import configparser
+import contextlib
+import fcntl
+import gzip
+import hashlib
 import json
+import math
 import multiprocessing
 import os
+import pickle
 import platform
 import re
 import resource
+import select
+import shlex
 import shutil
+import socket
 import subprocess
 import sys
+import sysconfig
 import tempfile
+import threading
+import time
+import traceback
+import uuid
 from subprocess import CalledProcessError, check_call
 from tempfile import TemporaryDirectory
 from urllib.parse import urljoin
 
-from git import Repo
-from git.exc import GitCommandError
+from git import Git, Repo
 
 # interpreter is not used directly but this resolves dependency ordering
 # that would be broken if we didn't include it.
 from mesonbuild import interpreter  # noqa: F401
 from mesonbuild import optinterpreter, options
+from mesonbuild.build import load as meson_build_load
 from mesonbuild.mesonlib import version_compare as meson_version_compare
 from mesonbuild.options import OptionKey, OptionStore
 
 
-class DepTree:
+class DepGraph:
     """
-    Represents package dependency tree, where each node is a DepTree with a
-    name and DepTree children.
+    Represents the package dependency graph, indexed by package name. Each
+    package maps to the ordered set of packages it requires.
     """
 
     def __init__(self, name):
         """
-        Create new DepTree.
+        Create new DepGraph.
 
         Parameter descriptions:
-        name               Name of new tree node.
+        name               Name of the root package.
         """
         self.name = name
-        self.children = list()
+        self.nodes = {name: dict()}
 
-    def AddChild(self, name):
+    def AddNode(self, name):
         """
-        Add new child node to current node.
+        Add new package node if not already present.
 
         Parameter descriptions:
-        name               Name of new child
+        name               Name of the package
         """
-        new_child = DepTree(name)
-        self.children.append(new_child)
-        return new_child
+        self.nodes.setdefault(name, dict())
 
-    def AddChildNode(self, node):
+    def AddEdge(self, name, dep):
         """
-        Add existing child node to current node.
+        Record that package 'name' requires package 'dep'.
 
         Parameter descriptions:
-        node               Tree node to add
+        name               Name of the package
+        dep                Name of the package it requires
         """
-        self.children.append(node)
+        self.AddNode(name)
+        self.AddNode(dep)
+        self.nodes[name][dep] = None
 
-    def RemoveChild(self, name):
+    def GetDependents(self, name):
         """
-        Remove child node.
+        Return set of names of packages that transitively require 'name'.
 
         Parameter descriptions:
-        name               Name of child to remove
+        name               Name of the package
         """
-        for child in self.children:
-            if child.name == name:
-                self.children.remove(child)
-                return
-
-    def GetNode(self, name):
+        reverse = {node: [] for node in self.nodes}
+        for node, deps in self.nodes.items():
+            for dep in deps:
+                reverse[dep].append(node)
+
+        dependents = set()
+        stack = [name]
+        while stack:
+            for node in reverse[stack.pop()]:
+                if node not in dependents:
+                    dependents.add(node)
+                    stack.append(node)
+        return dependents
+
+    def GetDependencies(self, name):
         """
-        Return node with matching name. Return None if not found.
+        Return set of names of packages that 'name' transitively requires.
 
         Parameter descriptions:
-        name               Name of node to return
+        name               Name of the package
         """
-        if self.name == name:
-            return self
-        for child in self.children:
-            node = child.GetNode(name)
-            if node:
-                return node
-        return None
+        dependencies = set()
+        stack = [name]
+        while stack:
+            for dep in self.nodes[stack.pop()]:
+                if dep not in dependencies:
+                    dependencies.add(dep)
+                    stack.append(dep)
+        return dependencies
+
+    def Prune(self):
+        """
+        Remove the packages which the root package no longer requires,
+        directly or transitively.
+        """
+        reachable = self.GetDependencies(self.name) | {self.name}
+        for name in list(self.nodes):
+            if name not in reachable:
+                del self.nodes[name]
 
-    def GetParentNode(self, name, parent_node=None):
+    def AddOrderingConstraint(self, name, regex_str):
         """
-        Return parent of node with matching name. Return none if not found.
+        Require packages with names matching 'regex_str' to be installed
+        before package 'name', unless they themselves require 'name'.
 
         Parameter descriptions:
-        name               Name of node to get parent of
-        parent_node        Parent of current node
+        name               Name of package to look for
+        regex_str          Regex string to match names to
         """
-        if self.name == name:
-            return parent_node
-        for child in self.children:
-            found_node = child.GetParentNode(name, self)
-            if found_node:
-                return found_node
-        return None
+        if name not in self.nodes:
+            return
+        dependents = self.GetDependents(name)
+        regex = re.compile(regex_str)
+        for node in list(self.nodes):
+            if node == name or node in dependents:
+                continue
+            if regex.match(node):
+                self.AddEdge(name, node)
 
-    def GetPath(self, name, path=None):
+    def GetInstallList(self, name=None):
         """
-        Return list of node names from head to matching name.
-        Return None if not found.
+        Return list of package names in which every package follows the
+        packages it requires, using an iterative depth-first post-order
+        traversal from the root package.
 
         Parameter descriptions:
-        name               Name of node
-        path               List of node names from head to current node
+        name               Name of the package to start from instead
         """
-        if not path:
-            path = []
-        if self.name == name:
-            path.append(self.name)
-            return path
-        for child in self.children:
-            match = child.GetPath(name, path + [self.name])
-            if match:
-                return match
-        return None
+        name = name or self.name
+        install_list = []
+        # Packages on the current traversal path are mapped to False
+        visited = {name: False}
+        stack = [(name, iter(self.nodes[name]))]
+        while stack:
+            name, deps = stack[-1]
+            for dep in deps:
+                state = visited.get(dep)
+                if state is None:
+                    visited[dep] = False
+                    stack.append((dep, iter(self.nodes[dep])))
+                    break
+                if state is False:
+                    raise Exception("Cyclic dependencies found in " + name)
+            else:
+                stack.pop()
+                visited[name] = True
+                install_list.append(name)
+        return install_list
 
-    def GetPathRegex(self, name, regex_str, path=None):
+    def GetDependencyMap(self):
+        """
+        Return dict of package names mapped to the set of names they require.
         """
-        Return list of node paths that end in name, or match regex_str.
-        Return empty list if not found.
+        return {name: set(deps) for name, deps in self.nodes.items()}
 
-        Parameter descriptions:
-        name               Name of node to search for
-        regex_str          Regex string to match node names
-        path               Path of node names from head to current node
+    def PrintTree(self):
+        """
+        Print the packages with indentation denoting the depth at which they
+        were first reached. Packages already printed are not expanded again.
         """
-        new_paths = []
-        if not path:
-            path = []
-        match = re.match(regex_str, self.name)
-        if (self.name == name) or (match):
-            new_paths.append(path + [self.name])
-        for child in self.children:
-            return_paths = None
-            full_path = path + [self.name]
-            return_paths = child.GetPathRegex(name, regex_str, full_path)
-            for i in return_paths:
-                new_paths.append(i)
-        return new_paths
+        INDENT_PER_LEVEL = 4
+        printed = set()
+        stack = [(self.name, 0)]
+        while stack:
+            name, level = stack.pop()
+            if name in printed:
+                print(" " * (level * INDENT_PER_LEVEL) + name + " (*)")
+                continue
+            printed.add(name)
+            print(" " * (level * INDENT_PER_LEVEL) + name)
+            for dep in reversed(list(self.nodes[name])):
+                stack.append((dep, level + 1))
+
+
+class Tracer:
+    """
+    Records the wall time, child CPU time and peak RSS of the script's phases
+    and of every command run through check_call_cmd() as Chrome trace events.
+    Events are appended to a shared file as they complete, so that forked
+    workers contribute to the same trace.
+    """
 
-    def MoveNode(self, from_name, to_name):
+    def __init__(self, path=None):
         """
-        Mode existing from_name node to become child of to_name node.
+        Create new Tracer. Tracing is disabled if no path is given.
 
         Parameter descriptions:
-        from_name          Name of node to make a child of to_name
-        to_name            Name of node to make parent of from_name
+        path               File to write the Chrome trace to
         """
-        parent_from_node = self.GetParentNode(from_name)
-        from_node = self.GetNode(from_name)
-        parent_from_node.RemoveChild(from_name)
-        to_node = self.GetNode(to_name)
-        to_node.AddChildNode(from_node)
-
-    def ReorderDeps(self, name, regex_str):
+        self.path = path
+        self.enabled = path is not None
+        self.owner = os.getpid()
+        self.lock = threading.Lock()
+        if self.enabled:
+            self.events_file = path + ".events"
+            open(self.events_file, "w").close()
+
+    def _emit(self, name, cat, start, end, args):
+        event = {
+            "name": name,
+            "cat": cat,
+            "ph": "X",
+            "ts": int(start * 1000000),
+            "dur": int((end - start) * 1000000),
+            "pid": os.getpid(),
+            "tid": threading.get_native_id(),
+            "args": args,
+        }
+        # A single append keeps concurrent writers' events intact
+        with self.lock:
+            with open(self.events_file, "a") as f:
+                f.write(json.dumps(event) + "\n")
+
+    @contextlib.contextmanager
+    def span(self, name, cat="phase"):
         """
-        Reorder dependency tree.  If tree contains nodes with names that
-        match 'name' and 'regex_str', move 'regex_str' nodes that are
-        to the right of 'name' node, so that they become children of the
-        'name' node.
+        Context manager recording the enclosed phase. CPU time is that of
+        all children reaped by this process during the phase, and peak RSS
+        that of the largest child reaped so far.
 
         Parameter descriptions:
-        name               Name of node to look for
-        regex_str          Regex string to match names to
+        name               Name of the phase
+        cat                Category of the phase
         """
-        name_path = self.GetPath(name)
-        if not name_path:
+        if not self.enabled:
+            yield
             return
-        paths = self.GetPathRegex(name, regex_str)
-        is_name_in_paths = False
-        name_index = 0
-        for i in range(len(paths)):
-            path = paths[i]
-            if path[-1] == name:
-                is_name_in_paths = True
-                name_index = i
-                break
-        if not is_name_in_paths:
+        start = time.time()
+        before = resource.getrusage(resource.RUSAGE_CHILDREN)
+        try:
+            yield
+        finally:
+            after = resource.getrusage(resource.RUSAGE_CHILDREN)
+            self._emit(
+                name,
+                cat,
+                start,
+                time.time(),
+                {
+                    "user": after.ru_utime - before.ru_utime,
+                    "system": after.ru_stime - before.ru_stime,
+                    "maxrss_kb": after.ru_maxrss,
+                },
+            )
+
+    def check_call(self, cmd, **kwargs):
+        """
+        Equivalent of subprocess.check_call() that records the exact resource
+        usage of the command, regardless of other concurrent commands.
+
+        Parameter descriptions:
+        cmd                List of parameters constructing the complete command
+        kwargs             Additional arguments to subprocess.Popen
+        """
+        start = time.time()
+        with subprocess.Popen(cmd, **kwargs) as p:
+            try:
+                _, status, usage = os.wait4(p.pid, 0)
+            except BaseException:
+                p.kill()
+                raise
+            p.returncode = os.waitstatus_to_exitcode(status)
+        self._emit(
+            " ".join(cmd),
+            "command",
+            start,
+            time.time(),
+            {
+                "user": usage.ru_utime,
+                "system": usage.ru_stime,
+                "maxrss_kb": usage.ru_maxrss,
+                "returncode": p.returncode,
+            },
+        )
+        if p.returncode:
+            raise CalledProcessError(p.returncode, cmd)
+
+    def finish(self):
+        """
+        Writes the Chrome trace file and prints a summary of the phases and
+        the longest running commands.
+        """
+        if not self.enabled or os.getpid() != self.owner:
             return
-        for i in range(name_index + 1, len(paths)):
-            path = paths[i]
-            if name in path:
-                continue
-            from_name = path[-1]
-            self.MoveNode(from_name, name)
+        with open(self.events_file, "r") as f:
+            events = [json.loads(line) for line in f]
+        with open(self.path, "w") as f:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
+        os.remove(self.events_file)
+
+        phases = sorted(
+            (e for e in events if e["cat"] == "phase"), key=lambda e: e["ts"]
+        )
+        commands = sorted(
+            (e for e in events if e["cat"] == "command"),
+            key=lambda e: e["dur"],
+            reverse=True,
+        )
+        header = "{:<48} {:>9} {:>9} {:>9} {:>9}".format(
+            "", "Wall(s)", "User(s)", "Sys(s)", "RSS(MiB)"
+        )
+        for title, rows in [
+            ("Phases", phases),
+            ("Longest commands", commands[:10]),
+        ]:
+            print(title + header[len(title) :])
+            for e in rows:
+                print(
+                    "{:<48} {:>9.1f} {:>9.1f} {:>9.1f} {:>9.1f}".format(
+                        e["name"][:48],
+                        e["dur"] / 1000000,
+                        e["args"]["user"],
+                        e["args"]["system"],
+                        e["args"]["maxrss_kb"] / 1024,
+                    )
+                )
+        print("Trace written to", self.path)
+
+
+class LogCapture:
+    """
+    Streams the output of the commands run through check_call_cmd() during a
+    phase into a compressed log of the phase, keeping only the last lines of
+    each command in memory to print should it fail, so that the output of
+    builds and test suites doesn't flood the console.
+    """
 
-    def GetInstallList(self):
+    def __init__(self, path, lines):
         """
-        Return post-order list of node names.
+        Parameter descriptions:
+        path               Directory to write the logs of the phases to
+        lines              Number of lines to keep of each command's output and
+                           to print of each failed test's, unlimited if 0,
+                           which streams the output to the console instead
+        """
+        self.path = path
+        self.lines = lines or None
+        self.enabled = lines > 0
+        self.log = None
+        self.lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        """
+        Context manager capturing the output of the commands run meanwhile in
+        the log of the named phase.
 
         Parameter descriptions:
+        name               Name of the phase
         """
-        install_list = []
-        for child in self.children:
-            child_install_list = child.GetInstallList()
-            install_list.extend(child_install_list)
-        install_list.append(self.name)
-        return install_list
+        if not self.enabled or self.log:
+            yield
+            return
+        os.makedirs(self.path, exist_ok=True)
+        path = os.path.join(
+            self.path, re.sub(r"[^\w.+-]+", "-", name) + ".log.gz"
+        )
+        printline("Logging the output of", name, "to", path)
+        # A phase resumed or run again appends another gzip member to its log
+        with gzip.open(path, "ab") as log:
+            self.log = (log, path)
+            try:
+                yield
+            finally:
+                self.log = None
+
+    def clear(self):
+        """
+        Removes the logs of the phases of earlier runs.
+        """
+        with contextlib.suppress(FileNotFoundError):
+            for entry in os.listdir(self.path):
+                if entry.endswith(".log.gz"):
+                    os.remove(os.path.join(self.path, entry))
 
-    def PrintTree(self, level=0):
+    def check_call(self, call, cmd, **kwargs):
         """
-        Print pre-order node names with indentation denoting node depth level.
+        Runs the command through the given equivalent of
+        subprocess.check_call() with its output captured in the log of the
+        current phase, and prints the end of the output should it fail.
 
         Parameter descriptions:
-        level              Current depth level
+        call               Function running the command
+        cmd                List of parameters constructing the complete command
+        kwargs             Additional arguments to call
         """
-        INDENT_PER_LEVEL = 4
-        print(" " * (level * INDENT_PER_LEVEL) + self.name)
-        for child in self.children:
-            child.PrintTree(level + 1)
+        if not self.log or "stdout" in kwargs:
+            call(cmd, **kwargs)
+            return
+        log, path = self.log
+        tail = collections.deque(maxlen=self.lines)
+        with self.lock:
+            log.write(f"{os.getcwd()} > {' '.join(cmd)}\n".encode())
+        read_fd, write_fd = os.pipe()
+
+        def drain():
+            with open(read_fd, "rb") as f:
+                # Bounds the memory taken by lines without a newline
+                for line in iter(lambda: f.readline(65536), b""):
+                    tail.append(line)
+                    with self.lock:
+                        log.write(line)
+
+        reader = threading.Thread(target=drain)
+        reader.start()
+        try:
+            try:
+                call(cmd, stdout=write_fd, stderr=write_fd, **kwargs)
+            finally:
+                os.close(write_fd)
+                reader.join()
+        except CalledProcessError:
+            # A single write keeps the output of concurrent commands intact
+            sys.stdout.write(
+                f"###### Last {len(tail)} lines of output,"
+                f" full log in {path} ######\n"
+                + b"".join(tail).decode("utf-8", "replace")
+            )
+            sys.stdout.flush()
+            raise
+
+
+def print_log_tail(title, lines):
+    """
+    Prints the last lines of a failed test's output under a heading, bounded
+    to the lines kept of captured output.
+
+    Parameter descriptions:
+    title               Heading of the output
+    lines               Iterable of the lines of the output
+    """
+    tail = collections.deque(maxlen=LOGS.lines)
+    count = 0
+    for count, line in enumerate(lines, 1):
+        tail.append(line if line.endswith("\n") else line + "\n")
+    if len(tail) < count:
+        title += f" (last {len(tail)} of {count} lines)"
+    sys.stdout.write(f"###### {title} ######\n" + "".join(tail))
+    sys.stdout.flush()
+
+
+def print_automake_failures(root):
+    """
+    Prints the end of the log of each test that failed according to the
+    automake test results under the given directory, followed by the paths
+    of the test suite logs holding the full output.
+
+    Parameter descriptions:
+    root                Directory the tests were run in
+    """
+    suites = []
+    for dirpath, _, files in os.walk(root):
+        for f in sorted(files):
+            path = os.path.join(dirpath, f)
+            if re.fullmatch("test-suite(-[a-z]+)?[.]log", f):
+                suites.append(path)
+            if not f.endswith(".trs"):
+                continue
+            with open(path, "r", errors="replace") as trs:
+                results = re.findall(
+                    "^:test-result: *(FAIL|ERROR|XPASS)", trs.read(), re.M
+                )
+            if not results:
+                continue
+            log = path.removesuffix(".trs") + ".log"
+            title = f"{os.path.relpath(log, root)}: {results[0]}"
+            if not os.path.exists(log):
+                print_log_tail(title, [])
+                continue
+            with open(log, "r", errors="replace") as f:
+                print_log_tail(title, f)
+    for path in suites:
+        print("Full test suite log:", path)
+
+
+def print_meson_failures(testlog):
+    """
+    Prints the end of the output of each test that failed according to the
+    JSON test log of a meson test run, followed by the path of the text log
+    holding the full output.
+
+    Parameter descriptions:
+    testlog             Path of the JSON test log
+    """
+    failed = False
+    with open(testlog, "r") as f:
+        for line in f:
+            result = json.loads(line)
+            if result["result"] in ["OK", "SKIP", "EXPECTEDFAIL"]:
+                continue
+            failed = True
+            output = result["stdout"] + result.get("stderr", "")
+            print_log_tail(
+                f"{result['name']}: {result['result']}",
+                output.splitlines(keepends=True),
+            )
+    if failed:
+        print("Full test log:", testlog.removesuffix(".json") + ".txt")
 
 
 def check_call_cmd(*cmd, **kwargs):
@@ -238,7 +545,65 @@ def check_call_cmd(*cmd, **kwargs):
     cmd                 List of parameters constructing the complete command
     """
     printline(os.getcwd(), ">", " ".join(cmd))
-    check_call(cmd, **kwargs)
+    with contextlib.ExitStack() as stack:
+        # A jobserver client gets one implicit job, which has to be taken
+        # from the jobserver so that the clients don't oversubscribe it
+        if JOBSERVER and JobServer.is_client(cmd):
+            stack.enter_context(JOBSERVER.hold())
+        LOGS.check_call(
+            TRACER.check_call if TRACER.enabled else check_call, cmd, **kwargs
+        )
+
+
+def sudo_cmd(*cmd):
+    """
+    Returns the command run as root through sudo, passing MAKEFLAGS on as
+    sudo strips it from the environment, so that make and ninja keep the
+    user's flags and the jobserver.
+
+    Parameter descriptions:
+    cmd                 List of parameters constructing the complete command
+    """
+    makeflags = os.environ.get("MAKEFLAGS")
+    if makeflags is None:
+        return ["sudo", "-n", "--", *cmd]
+    return ["sudo", "-n", "--", "env", f"MAKEFLAGS={makeflags}", *cmd]
+
+
+def update_mirror(pkg, pkg_repo):
+    """
+    Create or incrementally refresh the bare mirror of the given package's
+    repository in GIT_MIRROR, returning the mirror's path. When OFFLINE the
+    mirror is used as it is, and must already exist.
+
+    Parameter descriptions:
+    pkg                 Name of the package to mirror
+    pkg_repo            URL of the package's upstream repository
+    """
+    mirror_dir = os.path.join(GIT_MIRROR, pkg + ".git")
+    if OFFLINE:
+        if not os.path.isdir(mirror_dir):
+            raise Exception(f"No mirror of {pkg} in {GIT_MIRROR}")
+        return mirror_dir
+
+    os.makedirs(GIT_MIRROR, exist_ok=True)
+    # The mirror may be shared by concurrent jobs on the same host
+    with open(mirror_dir + ".lock", "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        if os.path.isdir(mirror_dir):
+            printline(mirror_dir, "> git fetch --prune origin")
+            Git(mirror_dir).fetch("--prune", "origin")
+        else:
+            printline(GIT_MIRROR, "> git clone --bare", pkg_repo)
+            partial = f"{mirror_dir}.{os.getpid()}.partial"
+            shutil.rmtree(partial, ignore_errors=True)
+            Git().clone("--bare", pkg_repo, partial)
+            # Only track branches, not gerrit's change refs
+            Git(partial).config(
+                "remote.origin.fetch", "+refs/heads/*:refs/heads/*"
+            )
+            os.rename(partial, mirror_dir)
+    return mirror_dir
 
 
 def clone_pkg(pkg, branch):
@@ -253,217 +618,2321 @@ def clone_pkg(pkg, branch):
     pkg_dir = os.path.join(WORKSPACE, pkg)
     if os.path.exists(os.path.join(pkg_dir, ".git")):
         return pkg_dir
-    pkg_repo = urljoin("https://gerrit.openbmc.org/openbmc/", pkg)
+    pkg_repo = urljoin(GIT_URL, pkg)
+    if GIT_MIRROR:
+        pkg_repo = update_mirror(pkg, pkg_repo)
+    # Choose the branch up front rather than retrying a failed clone
+    if not Git().ls_remote(pkg_repo, "refs/heads/" + branch):
+        # The mirror's branches are those of upstream as of its last refresh,
+        # so a branch missing from it may just not be mirrored yet
+        if OFFLINE:
+            raise Exception(f"Branch {branch} of {pkg} is not mirrored")
+        printline("Input branch not found, default to master")
+        branch = "master"
     os.mkdir(pkg_dir)
     printline(pkg_dir, "> git clone", pkg_repo, branch, "./")
+    # Only the checked out tree is needed, so avoid fetching the history's
+    # blobs (or the history itself if a depth was requested). Clones from
+    # the local mirror share its objects instead.
+    if GIT_MIRROR:
+        clone_args = {}
+    elif CLONE_DEPTH:
+        clone_args = {"depth": CLONE_DEPTH}
+    else:
+        clone_args = {"filter": "blob:none"}
+    with TRACER.span(f"{pkg}: clone"):
+        clone = Repo.clone_from(pkg_repo, pkg_dir, branch=branch, **clone_args)
+    return clone.working_dir
+
+
+# MAKE_TARGETS = [MAKEFILE PATH]:([MAKEFILE STAT], [SET OF TARGETS])
+MAKE_TARGETS = {}
+
+
+def make_targets():
+    """
+    Returns the set of targets defined by the makefile in the current
+    directory, read from make's database once per generation of the
+    makefile, so that reconfiguring the build tree invalidates it.
+    """
+    makefile = os.path.realpath("Makefile")
     try:
-        # first try the branch
-        clone = Repo.clone_from(pkg_repo, pkg_dir, branch=branch)
-        repo_inst = clone.working_dir
-    except GitCommandError:
-        printline("Input branch not found, default to master")
-        clone = Repo.clone_from(pkg_repo, pkg_dir, branch="master")
-        repo_inst = clone.working_dir
-    return repo_inst
+        stat = os.stat(makefile)
+    except OSError:
+        return set()
+    generation = (stat.st_ino, stat.st_size, stat.st_mtime_ns)
+    if MAKE_TARGETS.get(makefile, (None,))[0] == generation:
+        return MAKE_TARGETS[makefile][1]
+
+    # The database is printed without running any recipe, including those
+    # of recursive makes, and regardless of the exit status
+    database = subprocess.run(
+        ["make", "-pRrq", ".DEFAULT"],
+        stdout=subprocess.PIPE,
+        stderr=subprocess.DEVNULL,
+    ).stdout.decode("utf-8", "replace")
+    targets = set()
+    in_files = False
+    not_target = False
+    for line in database.splitlines():
+        if line.startswith("# Files"):
+            in_files = True
+        elif line.startswith("# Finished Make data base"):
+            break
+        elif line.startswith("# Not a target:"):
+            not_target = True
+        elif in_files and line and line[0] not in "#\t":
+            names, sep, rest = line.partition(":")
+            # Skip variable assignments and files make merely considered
+            if not sep or rest.startswith("=") or not_target:
+                not_target = False
+                continue
+            targets.update(
+                name
+                for name in names.split()
+                if not name.startswith(".") and "%" not in name
+            )
+    MAKE_TARGETS[makefile] = (generation, targets)
+    return targets
 
 
 def make_target_exists(target):
     """
-    Runs a check against the makefile in the current directory to determine
-    if the target exists so that it can be built.
+    Checks against the makefile in the current directory to determine if the
+    target exists so that it can be built.
 
     Parameter descriptions:
     target              The make target we are checking
     """
-    try:
-        cmd = ["make", "-n", target]
-        with open(os.devnull, "w") as devnull:
-            check_call(cmd, stdout=devnull, stderr=devnull)
-        return True
-    except CalledProcessError:
-        return False
+    return target in make_targets()
 
 
-make_parallel = [
-    "make",
-    # Run enough jobs to saturate all the cpus
-    "-j",
-    str(multiprocessing.cpu_count()),
-    # Don't start more jobs if the load avg is too high
-    "-l",
-    str(multiprocessing.cpu_count()),
-    # Synchronize the output so logs aren't intermixed in stdout / stderr
-    "-O",
-]
+def _cgroup_dirs(controller):
+    """
+    Returns the directories of the cgroups constraining this process for the
+    given controller, from its own cgroup up to the root of the hierarchy.
+
+    Parameter descriptions:
+    controller          Name of the cgroup v1 controller, e.g. cpu or memory
+    """
+    dirs = []
+    try:
+        with open("/proc/self/cgroup", "r") as f:
+            lines = f.read().splitlines()
+    except OSError:
+        return dirs
+    for line in lines:
+        _, controllers, path = line.split(":", 2)
+        if not controllers:
+            # cgroup v2 unified hierarchy
+            root = "/sys/fs/cgroup"
+        elif controller in controllers.split(","):
+            root = os.path.join("/sys/fs/cgroup", controllers)
+        else:
+            continue
+        path = path.strip("/")
+        while True:
+            cgroup_dir = os.path.join(root, path) if path else root
+            if os.path.isdir(cgroup_dir) and cgroup_dir not in dirs:
+                dirs.append(cgroup_dir)
+            if not path:
+                break
+            path = os.path.dirname(path)
+    return dirs
 
 
-def build_and_install(name, build_for_testing=False):
+def _read_cgroup_file(cgroup_dir, *names):
     """
-    Builds and installs the package in the environment. Optionally
-    builds the examples and test cases for package.
+    Returns the content of the first of the given cgroup files that can be
+    read, or None.
 
-    Parameter description:
-    name                The name of the package we are building
-    build_for_testing   Enable options related to testing on the package?
+    Parameter descriptions:
+    cgroup_dir          Directory of the cgroup
+    names               Names of the files, e.g. the v2 and v1 variants
     """
-    os.chdir(os.path.join(WORKSPACE, name))
+    for name in names:
+        try:
+            with open(os.path.join(cgroup_dir, name), "r") as f:
+                return f.read().strip()
+        except OSError:
+            pass
+    return None
 
-    # Refresh dynamic linker run time bindings for dependencies
-    check_call_cmd("sudo", "-n", "--", "ldconfig")
 
-    pkg = Package()
-    if build_for_testing:
-        pkg.test()
-    else:
-        pkg.install()
+def available_cpus():
+    """
+    Returns the number of CPUs this process may use, honouring both its CPU
+    affinity and the CPU quotas of its cgroups.
+    """
+    cpus = len(os.sched_getaffinity(0))
+    for cgroup_dir in _cgroup_dirs("cpu"):
+        quota = _read_cgroup_file(cgroup_dir, "cpu.max")
+        if quota:
+            quota, _, period = quota.partition(" ")
+        else:
+            quota = _read_cgroup_file(cgroup_dir, "cpu.cfs_quota_us")
+            period = _read_cgroup_file(cgroup_dir, "cpu.cfs_period_us")
+        try:
+            quota = int(quota) / int(period)
+        except (TypeError, ValueError):
+            # Unlimited or not readable
+            continue
+        if quota > 0:
+            cpus = min(cpus, max(1, int(quota)))
+    return cpus
 
 
-def build_dep_tree(name, pkgdir, dep_added, head, branch, dep_tree=None):
+def available_memory():
     """
-    For each package (name), starting with the package to be unit tested,
-    extract its dependencies. For each package dependency defined, recursively
-    apply the same strategy
+    Returns the number of bytes of memory available to this process, i.e.
+    the smaller of the system's available memory and the headroom left below
+    the memory limits of its cgroups.
+    """
+    available = math.inf
+    try:
+        with open("/proc/meminfo", "r") as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    available = int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    for cgroup_dir in _cgroup_dirs("memory"):
+        limit = _read_cgroup_file(
+            cgroup_dir, "memory.max", "memory.limit_in_bytes"
+        )
+        usage = _read_cgroup_file(
+            cgroup_dir, "memory.current", "memory.usage_in_bytes"
+        )
+        try:
+            available = min(available, max(0, int(limit) - int(usage)))
+        except (TypeError, ValueError):
+            # Unlimited or not readable
+            continue
+    return available
 
-    Parameter descriptions:
-    name                Name of the package
-    pkgdir              Directory where package source is located
-    dep_added           Current dict of dependencies and added status
-    head                Head node of the dependency tree
-    branch              Branch to clone from pkg
-    dep_tree            Current dependency tree node
+
+class JobServer:
+    """
+    A GNU make compatible jobserver sized from the CPUs and memory available
+    to the container. Its job slots are tokens in a named pipe, shared by
+    make (4.4 or later) and ninja (1.13 or later) through MAKEFLAGS and
+    handed out to meson test, so that concurrent builds and test runs don't
+    oversubscribe the CPUs between them.
     """
-    if not dep_tree:
-        dep_tree = head
 
-    with open("/tmp/depcache", "r") as depcache:
-        cache = depcache.readline()
+    # Memory to reserve for each compile job
+    JOB_MEMORY = 512 * 1024 * 1024
+    # Memory to reserve for each link job
+    LINK_MEMORY = 2 * 1024 * 1024 * 1024
 
-    # Read out pkg dependencies
-    pkg = Package(name, pkgdir)
+    def __init__(self, slots=None):
+        """
+        Create a new JobServer.
 
-    build = pkg.build_system()
-    if not build:
-        raise Exception(f"Unable to find build system for {name}.")
+        Parameter descriptions:
+        slots              Number of job slots, derived from the CPUs and
+                           memory available if None
+        """
+        if not slots:
+            memory = available_memory()
+            slots = available_cpus()
+            if not math.isinf(memory):
+                slots = min(slots, int(memory // JobServer.JOB_MEMORY))
+        self.slots = int(max(1, slots))
+        self.tempdir = tempfile.mkdtemp(prefix="jobserver")
+        self.path = os.path.join(self.tempdir, "fifo")
+        os.mkfifo(self.path, 0o600)
+        self._fd = os.open(self.path, os.O_RDWR | os.O_NONBLOCK)
+        os.write(self._fd, b"+" * self.slots)
 
-    for dep in set(build.dependencies()):
-        if dep in cache:
-            continue
-        # Dependency package not already known
-        if dep_added.get(dep) is None:
-            print(f"Adding {dep} dependency to {name}.")
-            # Dependency package not added
-            new_child = dep_tree.AddChild(dep)
-            dep_added[dep] = False
-            dep_pkgdir = clone_pkg(dep, branch)
-            # Determine this dependency package's
-            # dependencies and add them before
-            # returning to add this package
-            dep_added = build_dep_tree(
-                dep, dep_pkgdir, dep_added, head, branch, new_child
+    @staticmethod
+    def is_client(cmd):
+        """
+        Returns whether the given command joins the jobserver.
+
+        Parameter descriptions:
+        cmd                List of parameters constructing the command
+        """
+        cmd = list(cmd)
+        if cmd[:3] == ["sudo", "-n", "--"]:
+            cmd = cmd[3:]
+        if cmd[:1] == ["env"]:
+            cmd = cmd[1:]
+            while cmd and "=" in cmd[0]:
+                cmd = cmd[1:]
+        return cmd[:1] in (["make"], ["ninja"]) or cmd[:2] in (
+            ["meson", "compile"],
+            ["cmake", "--build"],
+        )
+
+    def environ(self):
+        """
+        Returns the environment variables making make and ninja join the
+        jobserver, keeping the flags of any MAKEFLAGS already set which don't
+        concern the number of jobs.
+        """
+        words = os.environ.get("MAKEFLAGS", "").split()
+        if words and not words[0].startswith("-") and "=" not in words[0]:
+            # make reads a first word without a dash as single letter flags
+            words[0] = "-" + words[0]
+        # Variable assignments follow a "--"
+        end = words.index("--") if "--" in words else len(words)
+        flags = [
+            flag
+            for flag in words[:end]
+            if not re.fullmatch(
+                r"-j\d*|--jobs(=\d*)?|--jobserver-(auth|fds)=\S*", flag
             )
-        else:
-            # Dependency package known and added
-            if dep_added[dep]:
-                continue
-            else:
-                # Cyclic dependency failure
-                raise Exception("Cyclic dependencies found in " + name)
+        ]
+        flags += [f"-j{self.slots}", f"--jobserver-auth=fifo:{self.path}"]
+        return {"MAKEFLAGS": " " + " ".join(flags + words[end:])}
+
+    def link_jobs(self):
+        """
+        Returns the number of concurrent link jobs the available memory
+        admits.
+        """
+        return int(
+            max(1, min(self.slots, available_memory() // self.LINK_MEMORY))
+        )
 
-    if not dep_added[name]:
-        dep_added[name] = True
+    def _take(self, count, block):
+        while True:
+            try:
+                return os.read(self._fd, count)
+            except BlockingIOError:
+                if not block:
+                    return b""
+                select.select([self._fd], [], [])
+
+    @contextlib.contextmanager
+    def hold(self, count=1):
+        """
+        Holds up to the given number of job slots, waiting for the first one
+        only, and yields the number of slots held.
 
-    return dep_added
+        Parameter descriptions:
+        count              Number of job slots wanted
+        """
+        tokens = self._take(1, True)
+        if count > 1:
+            tokens += self._take(count - 1, False)
+        try:
+            yield len(tokens)
+        finally:
+            os.write(self._fd, tokens)
 
+    def close(self):
+        os.close(self._fd)
+        shutil.rmtree(self.tempdir, ignore_errors=True)
 
-def valgrind_rlimit_nofile(soft=2048, hard=4096):
-    resource.setrlimit(resource.RLIMIT_NOFILE, (soft, hard))
 
+@contextlib.contextmanager
+def job_slots(jobs=None):
+    """
+    Yields the number of jobs a command which can't join the jobserver, such
+    as meson test, should run, holding that many job slots meanwhile.
 
-def is_valgrind_safe():
+    Parameter descriptions:
+    jobs                Number of jobs wanted, as many as possible if None
     """
-    Returns whether it is safe to run valgrind on our platform
+    if JOBSERVER:
+        with JOBSERVER.hold(jobs or JOBSERVER.slots) as held:
+            yield held
+    else:
+        yield jobs or available_cpus()
+
+
+def parallel_args(jobs):
     """
-    with tempfile.TemporaryDirectory() as temp:
-        src = os.path.join(temp, "unit-test-vg.c")
-        exe = os.path.join(temp, "unit-test-vg")
-        with open(src, "w") as h:
-            h.write("#include <errno.h>\n")
-            h.write("#include <stdio.h>\n")
-            h.write("#include <stdlib.h>\n")
-            h.write("#include <string.h>\n")
-            h.write("int main() {\n")
-            h.write("char *heap_str = malloc(16);\n")
-            h.write('strcpy(heap_str, "RandString");\n')
-            h.write('int res = strcmp("RandString", heap_str);\n')
-            h.write("free(heap_str);\n")
-            h.write("char errstr[64];\n")
-            h.write("strerror_r(EINVAL, errstr, sizeof(errstr));\n")
-            h.write('printf("%s\\n", errstr);\n')
-            h.write("return res;\n")
-            h.write("}\n")
-        check_call(
-            ["gcc", "-O2", "-o", exe, src],
-            stdout=subprocess.DEVNULL,
-            stderr=subprocess.DEVNULL,
-        )
-        try:
-            check_call(
-                ["valgrind", "--error-exitcode=99", exe],
-                stdout=subprocess.DEVNULL,
-                stderr=subprocess.DEVNULL,
-                preexec_fn=valgrind_rlimit_nofile,
-            )
-        except CalledProcessError:
-            sys.stderr.write("###### Platform is not valgrind safe ######\n")
-            return False
-        return True
+    Returns the ninja and make arguments to run the given number of jobs,
+    which are left to the jobserver if there is one.
 
+    Parameter descriptions:
+    jobs                Number of jobs to run
+    """
+    return [] if JOBSERVER else ["-j", str(jobs)]
 
-def is_sanitize_safe():
+
+make_parallel = [
+    "make",
+    # Run enough jobs to saturate all the cpus
+    "-j",
+    str(available_cpus()),
+    # Don't start more jobs if the load avg is too high
+    "-l",
+    str(available_cpus()),
+    # Synchronize the output so logs aren't intermixed in stdout / stderr
+    "-O",
+]
+
+# Number of jobs of each ninja and cmake build without a jobserver
+BUILD_JOBS = available_cpus()
+
+
+def limit_build_jobs(jobs):
     """
-    Returns whether it is safe to run sanitizers on our platform
+    Limits the builds run by this process to the given number of jobs, so
+    that builds running concurrently without a jobserver share the cpus.
+
+    Parameter descriptions:
+    jobs                Number of jobs each build may run
+    """
+    global BUILD_JOBS, make_parallel
+    BUILD_JOBS = jobs
+    make_parallel = [
+        "make",
+        "-j",
+        str(jobs),
+        "-l",
+        str(available_cpus()),
+        "-O",
+    ]
+
+
+class DepScanCache:
+    """
+    Persistent cache of the dependency lists extracted from build system
+    configuration, keyed by the content of the scanned files and the
+    DEPENDENCIES tables used to interpret them.
     """
-    src = "unit-test-sanitize.c"
-    exe = "./unit-test-sanitize"
-    with open(src, "w") as h:
-        h.write("int main() { return 0; }\n")
-    try:
-        with open(os.devnull, "w") as devnull:
-            check_call(
-                [
-                    "gcc",
-                    "-O2",
-                    "-fsanitize=address",
-                    "-fsanitize=undefined",
-                    "-o",
-                    exe,
-                    src,
-                ],
-                stdout=devnull,
-                stderr=devnull,
-            )
-            check_call([exe], stdout=devnull, stderr=devnull)
 
-        # TODO: Sanitizer not working on ppc64le
-        # https://github.com/openbmc/openbmc-build-scripts/issues/31
-        if platform.processor() == "ppc64le":
-            sys.stderr.write("###### ppc64le is not sanitize safe ######\n")
-            return False
-        else:
-            return True
-    except Exception:
-        sys.stderr.write("###### Platform is not sanitize safe ######\n")
-        return False
-    finally:
-        os.remove(src)
-        os.remove(exe)
+    def __init__(self, path):
+        """
+        Create new DepScanCache.
+
+        Parameter descriptions:
+        path               Directory the scan results are stored in
+        """
+        self.path = path
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(self.path, exist_ok=True)
+
+    def key(self, kind, contents):
+        """
+        Return the cache key for a scan.
+
+        Parameter descriptions:
+        kind               Name of the build system being scanned
+        contents           List of the contents of the scanned files
+        """
+        digest = hashlib.sha256()
+        for item in [
+            kind,
+            json.dumps(DEPENDENCIES, sort_keys=True),
+            json.dumps(DEPENDENCIES_OFFSET, sort_keys=True),
+        ] + contents:
+            digest.update(item.encode("utf-8"))
+            digest.update(b"\0")
+        return digest.hexdigest()
+
+    def get(self, key):
+        """
+        Return the cached list of dependencies, or None on a miss.
+
+        Parameter descriptions:
+        key                Cache key of the scan
+        """
+        try:
+            with open(os.path.join(self.path, key + ".json"), "r") as f:
+                deps = json.load(f)
+        except (OSError, ValueError):
+            self.misses += 1
+            return None
+        self.hits += 1
+        return deps
+
+    def put(self, key, deps):
+        """
+        Store the list of dependencies found by a scan.
+
+        Parameter descriptions:
+        key                Cache key of the scan
+        deps               List of dependencies found
+        """
+        entry = os.path.join(self.path, key + ".json")
+        partial = f"{entry}.{os.getpid()}.partial"
+        with open(partial, "w") as f:
+            json.dump(deps, f)
+        os.replace(partial, entry)
+
+
+class DepIndex:
+    """
+    Precomputed dependency graph of the packages in the organisation, stored
+    as a versioned JSON file mapping each branch to each package's commit and
+    dependencies at that commit. It is written by --update-dep-index and lets
+    the dependencies of a package be resolved without cloning it first.
+    """
+
+    # Bump when the file format changes
+    VERSION = 1
+
+    def __init__(self, path):
+        """
+        Create new DepIndex, loading the index file if it exists.
+
+        Parameter descriptions:
+        path               Path of the index file
+        """
+        self.path = path
+        self.branches = dict()
+        try:
+            with open(self.path, "r") as f:
+                index = json.load(f)
+        except (OSError, ValueError):
+            return
+        # Indexes scanned with other dependency tables are stale
+        if (
+            index.get("version") == DepIndex.VERSION
+            and index.get("scanner") == DepIndex.scanner()
+        ):
+            self.branches = index["branches"]
+
+    @staticmethod
+    def scanner():
+        """
+        Return a hash of the tables the dependencies were interpreted with.
+        """
+        return DEP_SCAN_CACHE.key("index", [])
+
+    def lookup(self, pkg, branch):
+        """
+        Return the package's {"sha": commit, "deps": dependencies} entry for
+        the branch, or None if it is not indexed.
+
+        Parameter descriptions:
+        pkg                Name of the package
+        branch             Branch the package is used from
+        """
+        return self.branches.get(branch, dict()).get(pkg)
+
+    def update(self, pkg, branch, sha, deps):
+        """
+        Record the package's dependencies at the given commit of the branch.
+
+        Parameter descriptions:
+        pkg                Name of the package
+        branch             Branch the package is used from
+        sha                Commit the dependencies were scanned at
+        deps               List of the package's dependencies
+        """
+        self.branches.setdefault(branch, dict())[pkg] = {
+            "sha": sha,
+            "deps": sorted(set(deps)),
+        }
+
+    def save(self):
+        """
+        Write the index file.
+        """
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        partial = f"{self.path}.{os.getpid()}.partial"
+        with open(partial, "w") as f:
+            json.dump(
+                {
+                    "version": DepIndex.VERSION,
+                    "scanner": DepIndex.scanner(),
+                    "branches": self.branches,
+                },
+                f,
+                sort_keys=True,
+                separators=(",", ":"),
+            )
+        os.replace(partial, self.path)
+
+
+def tree_fingerprint(pkgdir):
+    """
+    Returns a hash of the package's source tree, i.e. its checked out commit
+    and the uncommitted changes to its tracked files.
+
+    Parameter descriptions:
+    pkgdir              Directory of the package's git repository
+    """
+    digest = hashlib.sha256()
+    for cmd in [["rev-parse", "HEAD"], ["diff", "HEAD", "--binary"]]:
+        digest.update(
+            subprocess.check_output(["git", "-C", pkgdir, "--no-pager"] + cmd)
+        )
+    return digest.hexdigest()
+
+
+class Checkpoints:
+    """
+    Journal of the phases of a run which completed, each recorded with a hash
+    of its inputs, so that a resumed run can skip the phases whose inputs are
+    unchanged. Every hash includes a token of the system the run installs
+    into, so a fresh container invalidates the journal.
+    """
+
+    # Token identifying the installation, lost with a fresh container
+    SESSION = "/tmp/unit-test-session"
+
+    def __init__(self, path, resume):
+        """
+        Create new Checkpoints.
+
+        Parameter descriptions:
+        path               Path of the journal file
+        resume             Whether completed phases may be skipped, otherwise
+                           the journal is started afresh
+        """
+        self.path = path
+        self.resume = resume
+        self.phases = self._load() if resume else dict()
+        if not resume:
+            self._write(self.phases)
+        try:
+            with open(Checkpoints.SESSION, "x") as f:
+                f.write(uuid.uuid4().hex)
+        except FileExistsError:
+            pass
+        with open(Checkpoints.SESSION, "r") as f:
+            self.session = f.read()
+
+    def _load(self):
+        try:
+            with open(self.path, "r") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return dict()
+
+    def _write(self, phases):
+        partial = f"{self.path}.{os.getpid()}.partial"
+        with open(partial, "w") as f:
+            json.dump(phases, f, indent=1, sort_keys=True)
+        os.replace(partial, self.path)
+
+    def key(self, *inputs):
+        """
+        Return the hash of a phase's inputs.
+
+        Parameter descriptions:
+        inputs             Strings the phase's outcome depends on
+        """
+        digest = hashlib.sha256()
+        for item in (self.session,) + inputs:
+            digest.update(item.encode("utf-8"))
+            digest.update(b"\0")
+        return digest.hexdigest()
+
+    def install_keys(self, install_list, dep_map):
+        """
+        Return dict of the hashes of the install phase's inputs for each
+        package in install order.
+
+        Parameter descriptions:
+        install_list       List of packages in a valid install order
+        dep_map            Dict of package names to the set of names they
+                           require
+        """
+        keys = dict()
+        for name in install_list:
+            deps = dep_map.get(name, set()) & set(install_list)
+            keys[name] = self.key(
+                "install",
+                name,
+                tree_fingerprint(os.path.join(WORKSPACE, name)),
+                json.dumps(MESON_FLAGS.get(name)),
+                json.dumps(CONFIGURE_FLAGS.get(name)),
+                str(INTEGRATION_TEST),
+                *sorted(keys[dep] for dep in deps),
+            )
+        return keys
+
+    def done(self, phase, key):
+        """
+        Return whether the phase completed with the same inputs before and
+        may be skipped.
+
+        Parameter descriptions:
+        phase              Name of the phase
+        key                Hash of the phase's inputs
+        """
+        if not self.resume or not key or self.phases.get(phase) != key:
+            return False
+        print(f"Skipping {phase}, completed with the same inputs before")
+        return True
+
+    def record(self, phase, key):
+        """
+        Record that the phase completed.
+
+        Parameter descriptions:
+        phase              Name of the phase
+        key                Hash of the phase's inputs, if it can be resumed
+        """
+        if not key:
+            return
+        # Dependencies are installed by forked workers, so merge with what
+        # they recorded
+        with open(self.path + ".lock", "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            phases = self._load()
+            phases[phase] = key
+            self._write(phases)
+
+    def forget(self, phase):
+        """
+        Record that the phase's outcome was undone.
+
+        Parameter descriptions:
+        phase              Name of the phase
+        """
+        self.phases.pop(phase, None)
+        with open(self.path + ".lock", "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            phases = self._load()
+            if phases.pop(phase, None):
+                self._write(phases)
+
+
+class ArtifactCache:
+    """
+    Content-addressed cache of staged dependency install trees. Each artifact
+    is a tarball of a DESTDIR install, keyed by everything that determines
+    its contents, and is unpacked into the real prefix on a cache hit.
+    """
+
+    # Bump to invalidate all existing artifacts
+    VERSION = 2
+
+    def __init__(self, path, max_size):
+        """
+        Create new ArtifactCache.
+
+        Parameter descriptions:
+        path               Directory the artifacts are stored in
+        max_size           Total size in bytes beyond which the least recently
+                           used artifacts are evicted
+        """
+        self.path = path
+        self.max_size = max_size
+        os.makedirs(self.path, exist_ok=True)
+
+    def key(self, name, dep_keys):
+        """
+        Return the cache key of a package checked out in the workspace, or
+        None if the package can't be cached.
+
+        Parameter descriptions:
+        name               Name of the package
+        dep_keys           Cache keys of the packages it is built against
+        """
+        pkgdir = os.path.join(WORKSPACE, name)
+        if None in dep_keys or not os.path.isdir(os.path.join(pkgdir, ".git")):
+            return None
+        repo = Repo(pkgdir)
+        if repo.is_dirty(untracked_files=False):
+            return None
+        system = Package(name, pkgdir).build_system()
+        if not system:
+            return None
+
+        # The cache outlives the image, whose toolchain and preinstalled
+        # dependencies the artifacts are built against
+        with open("/tmp/depcache", "r") as depcache:
+            image_deps = depcache.read()
+
+        digest = hashlib.sha256()
+        for item in [
+            str(ArtifactCache.VERSION),
+            platform.machine(),
+            TOOLCHAIN.fingerprint(),
+            image_deps,
+            name,
+            repo.head.commit.hexsha,
+            type(system).__name__,
+            json.dumps(MESON_FLAGS.get(name)),
+            json.dumps(CONFIGURE_FLAGS.get(name)),
+            str(INTEGRATION_TEST),
+        ] + sorted(dep_keys):
+            digest.update(item.encode("utf-8"))
+            digest.update(b"\0")
+        return digest.hexdigest()
+
+    def keys(self, install_list, dep_map):
+        """
+        Return dict of cache keys for each package in install order.
+
+        Parameter descriptions:
+        install_list       List of packages in a valid install order
+        dep_map            Dict of package names to the set of names they
+                           require
+        """
+        keys = dict()
+        for name in install_list:
+            deps = dep_map.get(name, set()) & set(install_list)
+            keys[name] = self.key(name, [keys[dep] for dep in deps])
+        return keys
+
+    def _artifact(self, key):
+        return os.path.join(self.path, key + ".tar.gz")
+
+    def unpack(self, key):
+        """
+        Install the artifact into the real prefix. Return False on a miss.
+
+        Parameter descriptions:
+        key                Cache key of the artifact
+        """
+        artifact = self._artifact(key)
+        if not os.path.exists(artifact):
+            return False
+        # Record the use for least recently used eviction
+        os.utime(artifact)
+        # The dynamic linker's cache is refreshed once all dependencies are
+        # installed, see staged_install_environment()
+        with INSTALL_LOCK:
+            # The staging directory's private mode is recorded as "." and
+            # must not be applied to /. Like merge_staged(), the modes staged
+            # under umask 000 are masked by sudo's umask.
+            check_call_cmd(
+                "sudo",
+                "-n",
+                "--",
+                "tar",
+                "--no-overwrite-dir",
+                "--no-same-permissions",
+                "-C",
+                "/",
+                "-xzf",
+                artifact,
+            )
+        return True
+
+    def store(self, key, staging_dir):
+        """
+        Add a staged install tree to the cache.
+
+        Parameter descriptions:
+        key                Cache key of the artifact
+        staging_dir        DESTDIR the package was installed into
+        """
+        artifact = self._artifact(key)
+        partial = f"{artifact}.{os.getpid()}.partial"
+        check_call_cmd(
+            "tar",
+            "--owner=0",
+            "--group=0",
+            "-C",
+            staging_dir,
+            "-czf",
+            partial,
+            ".",
+        )
+        os.replace(partial, artifact)
+        self.evict()
+
+    def evict(self):
+        """
+        Remove the least recently used artifacts until the cache fits within
+        its size limit.
+        """
+        artifacts = []
+        for entry in os.scandir(self.path):
+            if not entry.name.endswith(".tar.gz"):
+                continue
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                continue
+            artifacts.append((stat.st_mtime, stat.st_size, entry.path))
+
+        total = sum(size for _, size, _ in artifacts)
+        for _, size, artifact in sorted(artifacts):
+            if total <= self.max_size:
+                break
+            printline("Evicting", artifact)
+            try:
+                os.remove(artifact)
+            except FileNotFoundError:
+                pass
+            total -= size
+
+
+class CompilerCache:
+    """
+    Compiler cache shared by the dependency builds, the build of the package
+    under test and its analysis variants, so that sources compiled with the
+    same flags before, in this run or a previous one, aren't compiled again.
+    """
+
+    # Counters of `ccache --print-stats` that are hits and misses
+    HITS = ["direct_cache_hit", "preprocessed_cache_hit"]
+    MISSES = ["cache_miss"]
+
+    def __init__(self, path, max_size):
+        """
+        Create new CompilerCache.
+
+        Parameter descriptions:
+        path               Directory the compiler cache is stored in
+        max_size           Size in bytes beyond which ccache evicts the least
+                           recently used results
+        """
+        self.path = path
+        self.max_size = max_size
+        # List of (phase, hits, misses) in the order the phases completed
+        self.phases = []
+        os.makedirs(self.path, exist_ok=True)
+
+    def environ(self):
+        """
+        Return the environment variables pointing ccache at the cache and
+        the build systems at ccache. Meson picks ccache up by itself.
+        """
+        return {
+            "CCACHE_DIR": self.path,
+            "CCACHE_MAXSIZE": f"{self.max_size // (1024 * 1024)}Mi",
+            # Hash the paths below the workspace relative to the working
+            # directory, so that the build directories of the package and
+            # its analysis variants share results
+            "CCACHE_BASEDIR": WORKSPACE,
+            "CCACHE_NOHASHDIR": "1",
+            "CMAKE_C_COMPILER_LAUNCHER": "ccache",
+            "CMAKE_CXX_COMPILER_LAUNCHER": "ccache",
+        }
+
+    @staticmethod
+    def wrap(compiler):
+        """
+        Return the compiler command run through ccache, for build systems
+        given the compiler through the environment or arguments.
+
+        Parameter descriptions:
+        compiler           Compiler command, e.g. "clang"
+        """
+        return "ccache " + compiler
+
+    def _counters(self):
+        output = subprocess.check_output(["ccache", "--print-stats"]).decode(
+            "utf-8"
+        )
+        counters = dict()
+        for line in output.splitlines():
+            name, _, value = line.partition("\t")
+            if value.isdigit():
+                counters[name] = int(value)
+        return counters
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        """
+        Context manager attributing the compilations made meanwhile to the
+        named phase.
+
+        Parameter descriptions:
+        name               Name of the phase
+        """
+        before = self._counters()
+        try:
+            yield
+        finally:
+            after = self._counters()
+            hits, misses = [
+                sum(after.get(c, 0) - before.get(c, 0) for c in counters)
+                for counters in [CompilerCache.HITS, CompilerCache.MISSES]
+            ]
+            if hits or misses:
+                self.phases.append((name, hits, misses))
+
+    def report(self):
+        """
+        Print the hit rate of each phase which compiled anything.
+        """
+        for name, hits, misses in self.phases:
+            print(
+                f"ccache: {name}: {hits} hits, {misses} misses"
+                f" ({100 * hits // (hits + misses)}% hit rate)"
+            )
+
+
+def compiler_cache_phase(name):
+    """
+    Returns a context manager attributing the compiler cache statistics
+    meanwhile to the named phase.
+
+    Parameter descriptions:
+    name                Name of the phase
+    """
+    if CCACHE:
+        return CCACHE.phase(name)
+    return contextlib.nullcontext()
+
+
+class WrapCache:
+    """
+    Cache of the sources of meson wrap subprojects, keyed by the hash of the
+    wrap file, so that subprojects are downloaded once per host rather than
+    on every run. Meson copies the cached source tree in place of
+    downloading it and then applies the wrap's patches as usual.
+
+    Only wraps pinning their sources are cached: wrap-git wraps whose
+    revision is a commit hash and wrap-file wraps with a source_hash. Any
+    other wrap could resolve to different sources later on and is left to
+    meson.
+    """
+
+    # Wrap keys which modify the downloaded sources, applied by meson
+    PATCH_KEYS = [
+        "patch_url",
+        "patch_fallback_url",
+        "patch_filename",
+        "patch_hash",
+        "patch_directory",
+        "diff_files",
+    ]
+
+    def __init__(self, path, offline):
+        """
+        Create new WrapCache.
+
+        Parameter descriptions:
+        path               Directory the subproject sources are stored in
+        offline            Fail on subprojects which aren't cached instead of
+                           downloading them
+        """
+        self.path = path
+        self.offline = offline
+        os.makedirs(self.path, exist_ok=True)
+
+    @staticmethod
+    def _wraps(source_dir):
+        """
+        Yields the name, contents and parsed section of each wrap file of
+        the project.
+        """
+        subprojects = os.path.join(source_dir, "subprojects")
+        if not os.path.isdir(subprojects):
+            return
+        for entry in sorted(os.listdir(subprojects)):
+            if not entry.endswith(".wrap"):
+                continue
+            with open(os.path.join(subprojects, entry), "rb") as f:
+                contents = f.read()
+            config = configparser.ConfigParser(interpolation=None)
+            try:
+                config.read_string(contents.decode("utf-8"))
+            except (configparser.Error, UnicodeDecodeError):
+                continue
+            sections = [s for s in config.sections() if s.startswith("wrap-")]
+            if sections and WrapCache._pinned(config[sections[0]]):
+                yield entry[: -len(".wrap")], contents, config[sections[0]]
+
+    @staticmethod
+    def _pinned(wrap):
+        """
+        Returns whether the wrap always resolves to the same sources.
+        """
+        if wrap.name == "wrap-git":
+            return bool(
+                re.fullmatch(
+                    "[0-9a-f]{40}|[0-9a-f]{64}", wrap.get("revision", "")
+                )
+            )
+        return wrap.name == "wrap-file" and bool(wrap.get("source_hash"))
+
+    def _entry(self, contents):
+        return os.path.join(self.path, hashlib.sha256(contents).hexdigest())
+
+    def _fetch(self, name, wrap, directory, entry, packagecache):
+        """
+        Download the unpatched sources of a subproject into the cache, taking
+        the source archive from the given package cache if meson downloaded
+        it there already.
+        """
+        config = configparser.ConfigParser(interpolation=None)
+        config[wrap.name] = {
+            k: v for k, v in wrap.items() if k not in WrapCache.PATCH_KEYS
+        }
+        with TemporaryDirectory(dir=self.path, prefix=".fetch-") as temp:
+            with open(os.path.join(temp, "meson.build"), "w") as f:
+                f.write("project('wrap-cache')\n")
+            os.mkdir(os.path.join(temp, "subprojects"))
+            with open(
+                os.path.join(temp, "subprojects", name + ".wrap"), "w"
+            ) as f:
+                config.write(f)
+            # Without its patches a subproject may lack a meson.build, which
+            # meson reports as a failure once the sources are in place
+            cmd = ["meson", "subprojects", "download", "--sourcedir", temp]
+            printline(os.getcwd(), ">", " ".join(cmd + [name]))
+            env = dict(os.environ, MESON_PACKAGE_CACHE_DIR=packagecache)
+            subprocess.call(cmd + [name], env=env)
+            source = os.path.join(temp, "subprojects", directory)
+            complete = os.path.isdir(source)
+            if complete and wrap.name == "wrap-git":
+                complete = (
+                    subprocess.call(
+                        ["git", "-C", source, "rev-parse", "--verify", "HEAD"],
+                        stdout=subprocess.DEVNULL,
+                        stderr=subprocess.DEVNULL,
+                    )
+                    == 0
+                )
+            if not complete:
+                raise Exception(f"Failed to download subproject {name}")
+            os.mkdir(os.path.join(temp, "entry"))
+            os.rename(source, os.path.join(temp, "entry", directory))
+            try:
+                os.rename(os.path.join(temp, "entry"), entry)
+            except OSError:
+                # Another build cached it meanwhile
+                pass
+
+    @contextlib.contextmanager
+    def package_cache(self, source_dir):
+        """
+        Context manager yielding a meson package cache directory holding the
+        cached sources of the project's subprojects which haven't been
+        downloaded yet. Once the context exits without an error, the
+        subprojects which meson downloaded meanwhile are added to the cache.
+
+        Parameter descriptions:
+        source_dir         Source directory of the meson project
+        """
+        subprojects = os.path.join(source_dir, "subprojects")
+        missing = dict()
+        with TemporaryDirectory(prefix="wraps-") as view:
+            for name, contents, wrap in WrapCache._wraps(source_dir):
+                directory = wrap.get("directory", name)
+                if os.path.exists(os.path.join(subprojects, directory)):
+                    continue
+                entry = self._entry(contents)
+                if os.path.isdir(entry):
+                    printline("Using cached subproject", name)
+                    os.symlink(
+                        os.path.join(entry, directory),
+                        os.path.join(view, directory),
+                    )
+                else:
+                    missing[name] = (wrap, directory, entry)
+            yield view
+
+            if self.offline:
+                return
+            # Only the subprojects meson resolved are worth caching, and
+            # their source archives were downloaded into the view
+            for name, (wrap, directory, entry) in missing.items():
+                if not os.path.exists(os.path.join(subprojects, directory)):
+                    continue
+                try:
+                    with TRACER.span(f"{name}: wrap download"):
+                        self._fetch(name, wrap, directory, entry, view)
+                except Exception as e:
+                    print(f"Not caching subproject {name}: {e}")
+
+
+# Default install prefix of all the supported build systems
+PREFIX = "/usr/local"
+
+
+def prefix_library_path():
+    """
+    Return the library directories of the prefix dependencies are installed
+    into, so that libraries merged there resolve before the dynamic linker's
+    cache has been refreshed.
+    """
+    libdirs = ["lib", "lib64"]
+    multiarch = sysconfig.get_config_var("MULTIARCH")
+    if multiarch:
+        libdirs.append(os.path.join("lib", multiarch))
+    return [os.path.join(PREFIX, libdir) for libdir in libdirs]
+
+
+@contextlib.contextmanager
+def staged_install_environment():
+    """
+    Context manager making dependencies merged into PREFIX usable by the
+    builds that follow, without running ldconfig after each of them.
+    """
+    saved = os.environ.get("LD_LIBRARY_PATH")
+    os.environ["LD_LIBRARY_PATH"] = os.pathsep.join(
+        prefix_library_path() + ([saved] if saved else [])
+    )
+    try:
+        yield
+    finally:
+        if saved is None:
+            del os.environ["LD_LIBRARY_PATH"]
+        else:
+            os.environ["LD_LIBRARY_PATH"] = saved
+
+
+def merge_staged(staging_dir):
+    """
+    Copy a staged install tree into the real prefix. Each package is merged
+    as soon as it is staged rather than all of them in one step at the end,
+    as the pkg-config and CMake files of its dependents' builds refer to its
+    files by their path in the prefix.
+
+    Parameter descriptions:
+    staging_dir         DESTDIR the package was installed into
+    """
+    # Modes aren't preserved, as the staging directory's own private mode
+    # would otherwise be applied to /, so sudo's umask masks the modes
+    # staged under umask 000
+    with INSTALL_LOCK:
+        check_call_cmd(
+            "sudo",
+            "-n",
+            "--",
+            "cp",
+            "-dR",
+            "--preserve=timestamps",
+            "--",
+            os.path.join(staging_dir, "."),
+            "/",
+        )
+
+
+def record_install(name, checkpoint):
+    """
+    Record that a dependency was installed into the prefix.
+
+    Parameter descriptions:
+    name                The name of the package
+    checkpoint          Hash of the package's inputs in CHECKPOINTS
+    """
+    CHECKPOINTS.record(f"{name}: install", checkpoint)
+    if PREFIX_INSTALLS:
+        PREFIX_INSTALLS.record(f"{name}: install", checkpoint)
+
+
+def build_and_install(
+    name,
+    build_for_testing=False,
+    cache_key=None,
+    checkpoint=None,
+    install=True,
+):
+    """
+    Builds and installs the package in the environment. Optionally
+    builds the examples and test cases for package.
+
+    Parameter description:
+    name                The name of the package we are building
+    build_for_testing   Enable options related to testing on the package?
+    cache_key           Key of the package in ARTIFACT_CACHE, if cacheable
+    checkpoint          Hash of the package's inputs in CHECKPOINTS
+    install             Whether to install the package built for testing
+    """
+    if not build_for_testing and (
+        CHECKPOINTS.done(f"{name}: install", checkpoint)
+        or (
+            PREFIX_INSTALLS
+            and PREFIX_INSTALLS.done(f"{name}: install", checkpoint)
+        )
+    ):
+        return
+    os.chdir(os.path.join(WORKSPACE, name))
+
+    if cache_key:
+        with TRACER.span(f"{name}: artifact cache"):
+            unpacked = ARTIFACT_CACHE.unpack(cache_key)
+        if unpacked:
+            printline("Installed", name, "from artifact cache")
+            record_install(name, checkpoint)
+            return
+
+    pkg = Package()
+    if build_for_testing:
+        # The package is installed as configured for testing, in place of
+        # any install of it as a dependency of an earlier job
+        if PREFIX_INSTALLS and install:
+            PREFIX_INSTALLS.forget(f"{name}: install")
+        # Refresh dynamic linker run time bindings for all dependencies at once
+        with INSTALL_LOCK:
+            check_call_cmd("sudo", "-n", "--", "ldconfig")
+        pkg.test(checkpoint, install)
+    else:
+        with LOGS.phase(f"{name}: install"):
+            pkg.install(cache_key=cache_key)
+        record_install(name, checkpoint)
+
+
+def install_deps(
+    install_list, dep_map, jobs=1, cache_keys=None, checkpoints=None
+):
+    """
+    Builds and installs each dependency as soon as all of its own
+    dependencies have been installed, running up to 'jobs' builds at a time.
+    Each build runs in a forked worker so that it may change directory
+    independently. Dependencies are installed into their own staging
+    directory and only the merge into PREFIX is serialized through
+    INSTALL_LOCK.
+
+    Parameter descriptions:
+    install_list        List of dependencies in a valid serial install order
+    dep_map             Dict of package names to the set of names they require
+    jobs                Maximum number of dependencies to build concurrently
+    cache_keys          Dict of package names to their ARTIFACT_CACHE keys
+    checkpoints         Dict of package names to their CHECKPOINTS hashes
+    """
+    if cache_keys is None:
+        cache_keys = dict()
+    if checkpoints is None:
+        checkpoints = dict()
+
+    with staged_install_environment():
+        _install_deps(install_list, dep_map, jobs, cache_keys, checkpoints)
+
+
+def _build_and_install_dep(build_jobs, name, cache_key, checkpoint):
+    if build_jobs:
+        limit_build_jobs(build_jobs)
+    build_and_install(name, False, cache_key, checkpoint)
+
+
+def _install_deps(install_list, dep_map, jobs, cache_keys, checkpoints):
+    if jobs <= 1 or len(install_list) <= 1:
+        for dep in install_list:
+            build_and_install(
+                dep, False, cache_keys.get(dep), checkpoints.get(dep)
+            )
+        return
+
+    pending = {
+        dep: set(dep_map.get(dep, set())) & set(install_list)
+        for dep in install_list
+    }
+    # Without a jobserver the concurrent builds split the cpus between them
+    build_jobs = None if JOBSERVER else max(1, available_cpus() // jobs)
+    context = multiprocessing.get_context("fork")
+    with concurrent.futures.ProcessPoolExecutor(
+        max_workers=jobs, mp_context=context
+    ) as executor:
+        running = dict()
+        while pending or running:
+            # Preserve the serial install order among the ready packages
+            for dep in [d for d in install_list if d in pending]:
+                if pending[dep] or len(running) >= jobs:
+                    continue
+                del pending[dep]
+                printline("Scheduling build of", dep)
+                future = executor.submit(
+                    _build_and_install_dep,
+                    build_jobs,
+                    dep,
+                    cache_keys.get(dep),
+                    checkpoints.get(dep),
+                )
+                running[future] = dep
+
+            if not running:
+                raise Exception(
+                    "Cyclic dependencies found in " + ", ".join(pending)
+                )
+
+            done, _ = concurrent.futures.wait(
+                running, return_when=concurrent.futures.FIRST_COMPLETED
+            )
+            for future in done:
+                dep = running.pop(future)
+                try:
+                    future.result()
+                except Exception:
+                    for f in running:
+                        f.cancel()
+                    sys.stderr.write(f"###### Failed to build {dep} ######\n")
+                    raise
+                printline("Installed", dep)
+                for deps in pending.values():
+                    deps.discard(dep)
+
+
+def build_dep_tree(name, pkgdir, dep_graph, branch, jobs=1):
+    """
+    For each package (name), starting with the package to be unit tested,
+    extract its dependencies. Each newly found dependency is cloned in the
+    background, and its own dependencies are extracted once the clone has
+    completed, until no unknown dependencies remain. The dependencies of
+    packages in DEP_INDEX are taken from it without waiting for their clone,
+    which is only scanned if it is not at the indexed commit.
+
+    Parameter descriptions:
+    name                Name of the package
+    pkgdir              Directory where package source is located
+    dep_graph           Dependency graph to record the dependencies in
+    branch              Branch to clone from pkg
+    jobs                Maximum number of dependencies to clone concurrently
+    """
+    with open("/tmp/depcache", "r") as depcache:
+        cache = depcache.readline()
+
+    known = {name}
+    scan_queue = [(name, pkgdir)]
+    # Commits at which the index recorded the packages' dependencies
+    indexed = dict()
+    failed = dict()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+        clones = dict()
+
+        def add_dependencies(pkg_name, deps):
+            for dep in set(deps):
+                if dep in cache:
+                    continue
+                dep_graph.AddEdge(pkg_name, dep)
+                # Dependency package not already known
+                if dep not in known:
+                    print(f"Adding {dep} dependency to {pkg_name}.")
+                    known.add(dep)
+                    future = executor.submit(clone_pkg, dep, branch)
+                    clones[future] = dep
+                    entry = (
+                        DEP_INDEX.lookup(dep, branch) if DEP_INDEX else None
+                    )
+                    if entry:
+                        indexed[dep] = entry["sha"]
+                        add_dependencies(dep, entry["deps"])
+
+        while True:
+            for pkg_name, pkg_dir in scan_queue:
+                if pkg_name in indexed:
+                    if Repo(pkg_dir).head.commit.hexsha == indexed[pkg_name]:
+                        continue
+                    printline(f"Dependency index is stale for {pkg_name}")
+                    # Dependencies only reachable through the index's edges
+                    # drop out of the install list
+                    dep_graph.nodes[pkg_name].clear()
+
+                # Read out pkg dependencies
+                pkg = Package(pkg_name, pkg_dir)
+
+                build = pkg.build_system()
+                if not build:
+                    raise Exception(
+                        f"Unable to find build system for {pkg_name}."
+                    )
+
+                add_dependencies(pkg_name, build.dependencies())
+            scan_queue = []
+
+            if not clones:
+                break
+
+            done, _ = concurrent.futures.wait(
+                clones, return_when=concurrent.futures.FIRST_COMPLETED
+            )
+            for future in done:
+                dep = clones.pop(future)
+                try:
+                    scan_queue.append((dep, future.result()))
+                except Exception as e:
+                    failed[dep] = e
+
+    # A stale index entry may have named packages which can't be cloned,
+    # which only matters if they are still required
+    for dep, e in failed.items():
+        if dep_graph.name in dep_graph.GetDependents(dep):
+            raise e
+        printline(f"Ignoring {dep}, which is no longer a dependency")
+
+    # Cyclic dependencies are reported when the install order is determined
+    return dep_graph
+
+
+def update_dep_index(dep_index, repos, branch, jobs=1):
+    """
+    Scan the dependencies of the given repositories' branch into the
+    dependency index, only fetching and scanning the repositories whose head
+    commit changed since they were last indexed.
+
+    Parameter descriptions:
+    dep_index           DepIndex to update
+    repos               Dict of package names mapped to their repository URL
+    branch              Branch to index, or master where it doesn't exist
+    jobs                Maximum number of repositories to fetch concurrently
+    """
+
+    def fetch(pkg, pkg_repo, workdir):
+        if GIT_MIRROR:
+            pkg_repo = update_mirror(pkg, pkg_repo)
+        for ref in dict.fromkeys([branch, "master"]):
+            heads = Git().ls_remote(pkg_repo, "refs/heads/" + ref)
+            if heads:
+                break
+        else:
+            return None, None
+        sha = heads.split()[0]
+        entry = dep_index.lookup(pkg, branch)
+        if entry and entry["sha"] == sha:
+            return sha, None
+        pkg_dir = os.path.join(workdir, pkg)
+        printline(pkg_dir, "> git clone --depth 1", pkg_repo, ref, "./")
+        # Only the build system files at the head commit are scanned
+        Git().clone(
+            "--depth", "1", "--branch", ref, "--no-local", pkg_repo, pkg_dir
+        )
+        return sha, pkg_dir
+
+    unchanged = 0
+    with TemporaryDirectory(prefix="dep-index") as workdir:
+        with concurrent.futures.ThreadPoolExecutor(jobs) as executor:
+            futures = {
+                executor.submit(fetch, pkg, pkg_repo, workdir): pkg
+                for pkg, pkg_repo in repos.items()
+            }
+            for future in concurrent.futures.as_completed(futures):
+                pkg = futures[future]
+                sha, pkg_dir = future.result()
+                if not sha:
+                    print(f"No {branch} or master branch in {pkg}, skipping")
+                elif not pkg_dir:
+                    unchanged += 1
+                else:
+                    build = Package(pkg, pkg_dir).build_system()
+                    deps = build.dependencies() if build else []
+                    dep_index.update(pkg, branch, sha, deps)
+                    shutil.rmtree(pkg_dir)
+    dep_index.save()
+    print(
+        f"Indexed {len(repos) - unchanged} changed and {unchanged} unchanged"
+        f" repositories of {branch} into {dep_index.path}"
+    )
+
+
+def valgrind_rlimit_nofile(soft=2048, hard=4096):
+    resource.setrlimit(resource.RLIMIT_NOFILE, (soft, hard))
+
+
+def _compile_and_run(temp, source, compiler, *flags, wrapper=None, **kwargs):
+    """
+    Compiles the given C source in the temporary directory and executes the
+    result, raising CalledProcessError if either step fails.
+
+    Parameter descriptions:
+    temp                Temporary directory to build in
+    source              C source of the program
+    compiler            Compiler to build the program with
+    flags               Additional compiler flags
+    wrapper             List of arguments to execute the program under
+    """
+    src = os.path.join(temp, "unit-test-probe.c")
+    exe = os.path.join(temp, "unit-test-probe")
+    with open(src, "w") as h:
+        h.write(source)
+    check_call(
+        [compiler, *flags, "-o", exe, src],
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+        cwd=temp,
+    )
+    check_call(
+        (wrapper or []) + [exe],
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+        cwd=temp,
+        **kwargs,
+    )
+
+
+def _probe_valgrind(temp):
+    source = (
+        "#include <errno.h>\n"
+        "#include <stdio.h>\n"
+        "#include <stdlib.h>\n"
+        "#include <string.h>\n"
+        "int main() {\n"
+        "char *heap_str = malloc(16);\n"
+        'strcpy(heap_str, "RandString");\n'
+        'int res = strcmp("RandString", heap_str);\n'
+        "free(heap_str);\n"
+        "char errstr[64];\n"
+        "strerror_r(EINVAL, errstr, sizeof(errstr));\n"
+        'printf("%s\\n", errstr);\n'
+        "return res;\n"
+        "}\n"
+    )
+    try:
+        _compile_and_run(
+            temp,
+            source,
+            "gcc",
+            "-O2",
+            wrapper=["valgrind", "--error-exitcode=99"],
+            preexec_fn=valgrind_rlimit_nofile,
+        )
+    except (CalledProcessError, OSError):
+        sys.stderr.write("###### Platform is not valgrind safe ######\n")
+        return False
+    return True
+
+
+def _probe_sanitize(temp):
+    try:
+        _compile_and_run(
+            temp,
+            "int main() { return 0; }\n",
+            "gcc",
+            "-O2",
+            "-fsanitize=address",
+            "-fsanitize=undefined",
+        )
+    except (CalledProcessError, OSError):
+        sys.stderr.write("###### Platform is not sanitize safe ######\n")
+        return False
+
+    # TODO: Sanitizer not working on ppc64le
+    # https://github.com/openbmc/openbmc-build-scripts/issues/31
+    if platform.processor() == "ppc64le":
+        sys.stderr.write("###### ppc64le is not sanitize safe ######\n")
+        return False
+    return True
+
+
+def _probe_clang(temp):
+    try:
+        _compile_and_run(temp, "int main() { return 0; }\n", "clang", "-O2")
+    except (CalledProcessError, OSError):
+        return False
+    return True
+
+
+def _probe_lld(temp):
+    try:
+        _compile_and_run(
+            temp, "int main() { return 0; }\n", "clang", "-fuse-ld=lld"
+        )
+    except (CalledProcessError, OSError):
+        return False
+    return True
+
+
+def _probe_gcov(temp):
+    try:
+        _compile_and_run(
+            temp, "int main() { return 0; }\n", "gcc", "--coverage"
+        )
+    except (CalledProcessError, OSError):
+        return False
+    # The name of the coverage data file varies between gcc versions
+    return any(f.endswith(".gcda") for f in os.listdir(temp))
+
+
+def _probe_gcovr(temp):
+    return shutil.which("gcovr") is not None
+
+
+def _probe_lcov(temp):
+    return all(shutil.which(tool) for tool in ["lcov", "genhtml"])
+
+
+def _probe_jobserver(temp):
+    # make joins a named pipe jobserver from 4.4 on, and fails before
+    fifo = os.path.join(temp, "jobserver")
+    os.mkfifo(fifo)
+    fd = os.open(fifo, os.O_RDWR | os.O_NONBLOCK)
+    try:
+        os.write(fd, b"+")
+        with open(os.path.join(temp, "Makefile"), "w") as f:
+            f.write("all: a b\na b:\n\t@true\n")
+        check_call(
+            ["make", "-C", temp],
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+            env=dict(
+                os.environ, MAKEFLAGS=f" -j2 --jobserver-auth=fifo:{fifo}"
+            ),
+        )
+        version = subprocess.check_output(["ninja", "--version"])
+    except (CalledProcessError, OSError):
+        return False
+    finally:
+        os.close(fd)
+    # ninja joins it from 1.13 on, and ignores it before
+    match = re.match(r"(\d+)\.(\d+)", version.decode("utf-8"))
+    return bool(match) and tuple(map(int, match.groups())) >= (1, 13)
+
+
+def _probe_ccache(temp):
+    # Statistics are printed in a machine readable form from ccache 4 on
+    try:
+        check_call(
+            ["ccache", "--print-stats"],
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+            env=dict(os.environ, CCACHE_DIR=temp),
+        )
+    except (CalledProcessError, OSError):
+        return False
+    return True
+
+
+# TOOLCHAIN_PROBES = [PROBE]:([TOOLS THE RESULT DEPENDS ON], [PROBE FUNCTION])
+TOOLCHAIN_PROBES = {
+    "valgrind": (["gcc", "valgrind"], _probe_valgrind),
+    "sanitize": (["gcc"], _probe_sanitize),
+    "clang": (["clang"], _probe_clang),
+    "lld": (["clang", "ld.lld"], _probe_lld),
+    "gcov": (["gcc", "gcov"], _probe_gcov),
+    "gcovr": (["gcovr"], _probe_gcovr),
+    "lcov": (["lcov", "genhtml"], _probe_lcov),
+    "jobserver": (["make", "ninja"], _probe_jobserver),
+    "ccache": (["ccache"], _probe_ccache),
+}
+
+
+class ToolchainProbes:
+    """
+    Runs the TOOLCHAIN_PROBES capability checks at most once per toolchain
+    fingerprint, persisting the results so that later invocations using the
+    same toolchain (e.g. in the same container image) reuse them. Only
+    passing probes are persisted: a failure may be transient or depend on
+    host settings outside the fingerprint (e.g. vm.mmap_rnd_bits for ASan),
+    and would otherwise disable the feature for good.
+    """
+
+    # Versions of the tools, which don't change while a process (or worker
+    # and the jobs forked from it) runs
+    versions = dict()
+
+    def __init__(self, path):
+        """
+        Create new ToolchainProbes.
+
+        Parameter descriptions:
+        path               Directory the probe results are stored in
+        """
+        self.path = path
+        self.results = None
+        os.makedirs(self.path, exist_ok=True)
+
+    @staticmethod
+    def _tool_version(tool):
+        if tool in ToolchainProbes.versions:
+            return ToolchainProbes.versions[tool]
+        try:
+            output = subprocess.check_output(
+                [tool, "--version"], stderr=subprocess.STDOUT
+            ).decode("utf-8")
+            version = output.splitlines()[0] if output else ""
+        except (CalledProcessError, OSError):
+            version = "missing"
+        ToolchainProbes.versions[tool] = version
+        return version
+
+    def fingerprint(self):
+        """
+        Return a hash identifying the architecture, the kernel and the
+        versions of the tools that the probes depend on.
+        """
+        tools = sorted(
+            {tool for tools, _ in TOOLCHAIN_PROBES.values() for tool in tools}
+        )
+        digest = hashlib.sha256()
+        for item in [
+            platform.machine(),
+            platform.processor(),
+            platform.release(),
+        ] + [
+            tool + "=" + ToolchainProbes._tool_version(tool) for tool in tools
+        ]:
+            digest.update(item.encode("utf-8"))
+            digest.update(b"\0")
+        return digest.hexdigest()
+
+    def _load(self):
+        self.results_file = os.path.join(
+            self.path, self.fingerprint() + ".json"
+        )
+        try:
+            with open(self.results_file, "r") as f:
+                self.results = json.load(f)
+        except (OSError, ValueError):
+            self.results = dict()
+
+    def probe_all(self):
+        """
+        Run the probes which have no result for this toolchain yet.
+        """
+        if self.results is None:
+            self._load()
+        for name in TOOLCHAIN_PROBES:
+            if name not in self.results:
+                self.check(name)
+
+    def check(self, name):
+        """
+        Return the result of the named probe, running it if this toolchain
+        has not been probed before.
+
+        Parameter descriptions:
+        name               Name of the probe in TOOLCHAIN_PROBES
+        """
+        if self.results is None:
+            self._load()
+        if name in self.results:
+            printline(
+                "Using cached", name, "probe result:", self.results[name]
+            )
+            return self.results[name]
+
+        _, probe = TOOLCHAIN_PROBES[name]
+        with tempfile.TemporaryDirectory() as temp:
+            self.results[name] = probe(temp)
+
+        if not self.results[name]:
+            printline(name, "probe failed, which is not persisted")
+            return self.results[name]
+        partial = f"{self.results_file}.{os.getpid()}.partial"
+        with open(partial, "w") as f:
+            json.dump({k: v for k, v in self.results.items() if v}, f)
+        os.replace(partial, self.results_file)
+        return self.results[name]
+
+
+def is_valgrind_safe():
+    """
+    Returns whether it is safe to run valgrind on our platform
+    """
+    return TOOLCHAIN.check("valgrind")
+
+
+def is_sanitize_safe():
+    """
+    Returns whether it is safe to run sanitizers on our platform
+    """
+    return TOOLCHAIN.check("sanitize")
+
+
+def is_single_pass_coverage(build_for_testing, report_probes):
+    """
+    Returns whether coverage should be collected during the plain test run
+    instead of a separate instrumented run, which requires single-pass mode
+    and a toolchain able to produce the coverage report.
+
+    Parameter descriptions:
+    build_for_testing   Whether the package is being built for testing
+    report_probes       List of probes, any of which can produce the report
+    """
+    if not (build_for_testing and SINGLE_PASS) or TEST_ONLY:
+        return False
+    if not TOOLCHAIN.check("gcov"):
+        return False
+    return any(TOOLCHAIN.check(probe) for probe in report_probes)
+
+
+def report_single_pass_savings(builds, runs, tests):
+    """
+    Reports the work single-pass mode avoided.
+
+    Parameter descriptions:
+    builds              Number of builds saved
+    runs                Number of test suite runs saved
+    tests               Number of individual test executions saved
+    """
+    print(
+        f"Single-pass coverage saved {builds} build(s), {runs} test suite"
+        f" run(s) and {tests} test execution(s)"
+    )
+
+
+def changed_files(source_dir):
+    """
+    Returns the set of absolute paths changed by the commit under test,
+    including any uncommitted changes, or None if they can't be determined.
+
+    Parameter descriptions:
+    source_dir          Directory within the git repository under test
+    """
+    try:
+        top = subprocess.check_output(
+            ["git", "-C", source_dir, "rev-parse", "--show-toplevel"],
+            stderr=subprocess.DEVNULL,
+        ).decode("utf-8")
+        output = subprocess.check_output(
+            ["git", "-C", source_dir, "diff", "--name-only", "HEAD~1"],
+            stderr=subprocess.DEVNULL,
+        ).decode("utf-8")
+    except CalledProcessError:
+        return None
+    return {
+        os.path.realpath(os.path.join(top.strip(), f))
+        for f in output.splitlines()
+        if f
+    }
+
+
+# Files whose changes may affect the compilation of any translation unit
+BUILD_FILES = [
+    ".clang-tidy",
+    "meson.build",
+    "meson.options",
+    "meson_options.txt",
+    "CMakeLists.txt",
+    "configure.ac",
+    "Makefile.am",
+]
+
+
+class ClangTidyCache:
+    """
+    Persistent record of translation units that clang-tidy found clean,
+    keyed by the preprocessed translation unit, its compiler arguments, the
+    clang-tidy configuration and the clang-tidy version.
+    """
+
+    def __init__(self, path):
+        """
+        Create new ClangTidyCache.
+
+        Parameter descriptions:
+        path               Directory the clean results are recorded in
+        """
+        self.path = path
+        os.makedirs(self.path, exist_ok=True)
+
+    def key(self, *inputs):
+        """
+        Return the cache key for a translation unit.
+
+        Parameter descriptions:
+        inputs             Byte strings determining the clang-tidy result
+        """
+        digest = hashlib.sha256()
+        for item in inputs:
+            digest.update(item)
+            digest.update(b"\0")
+        return digest.hexdigest()
+
+    def is_clean(self, key):
+        return os.path.exists(os.path.join(self.path, key))
+
+    def set_clean(self, key):
+        open(os.path.join(self.path, key), "w").close()
+
+
+def _preprocess_args(entry):
+    """
+    Returns the arguments of a compile_commands.json entry rewritten to
+    write the preprocessed translation unit to stdout, without side effects
+    in the build directory.
+
+    Parameter descriptions:
+    entry               The compile_commands.json entry
+    """
+    if "arguments" in entry:
+        cmd = list(entry["arguments"])
+    else:
+        cmd = shlex.split(entry["command"])
+    # Preprocessing through ccache would only be passed through to the
+    # compiler
+    if os.path.basename(cmd[0]) == "ccache":
+        cmd = cmd[1:]
+    pp_args = []
+    skip = False
+    for arg in cmd:
+        if skip:
+            skip = False
+        elif arg in ["-o", "-MF", "-MQ", "-MT"]:
+            skip = True
+        elif arg in ["-c", "-MD", "-MMD"] or arg.startswith("-o"):
+            continue
+        else:
+            pp_args.append(arg)
+    # Comments are kept since they can carry NOLINT suppressions
+    return pp_args + ["-E", "-C"]
+
+
+def run_clang_tidy(build_dir, jobs, header_filter=None):
+    """
+    Runs clang-tidy over the translation units in the build directory's
+    compile_commands.json that are affected by the commit under test, i.e.
+    that are changed or include a changed file. All translation units are
+    considered if the changes can't be determined or touch BUILD_FILES.
+    Translation units previously found clean with identical inputs are
+    skipped.
+
+    Parameter descriptions:
+    build_dir           Build directory containing compile_commands.json
+    jobs                Number of translation units to process concurrently
+    header_filter       Regex of headers to report diagnostics from
+    """
+    with open(os.path.join(build_dir, "compile_commands.json"), "r") as f:
+        entries = json.load(f)
+
+    changed = changed_files(".")
+    analyze_all = changed is None or any(
+        os.path.basename(f) in BUILD_FILES for f in changed
+    )
+    config = b""
+    for path in sorted(find_file(".clang-tidy", ".")):
+        with open(path, "rb") as f:
+            config += f.read()
+    version = subprocess.check_output(["clang-tidy", "--version"])
+    build_path = os.path.realpath(build_dir)
+    tidy_args = ["clang-tidy", "--quiet", "-p", build_dir]
+    if header_filter:
+        tidy_args.append("-header-filter=" + header_filter)
+
+    def check(entry):
+        source = os.path.realpath(
+            os.path.join(entry["directory"], entry["file"])
+        )
+        # Generated sources and subprojects aren't ours to analyze
+        if source.startswith(build_path + os.sep) or (
+            os.sep + "subprojects" + os.sep in source
+        ):
+            return "skipped"
+
+        pp_args = _preprocess_args(entry)
+        try:
+            preprocessed = subprocess.check_output(
+                pp_args, cwd=entry["directory"], stderr=subprocess.DEVNULL
+            )
+        except CalledProcessError:
+            preprocessed = None
+
+        key = None
+        if preprocessed is not None:
+            includes = {
+                os.path.realpath(
+                    os.path.join(entry["directory"], m.decode("utf-8"))
+                )
+                for m in re.findall(rb'^# \d+ "([^"]+)"', preprocessed, re.M)
+            }
+            if not analyze_all and source not in changed:
+                if not includes & changed:
+                    return "skipped"
+            key = CLANG_TIDY_CACHE.key(
+                preprocessed,
+                " ".join(pp_args).encode("utf-8"),
+                config,
+                version,
+            )
+            if CLANG_TIDY_CACHE.is_clean(key):
+                return "cached"
+
+        try:
+            check_call_cmd(*tidy_args, source)
+        except CalledProcessError:
+            return "failed"
+        if key:
+            CLANG_TIDY_CACHE.set_clean(key)
+        return "clean"
+
+    with concurrent.futures.ThreadPoolExecutor(jobs) as executor:
+        results = list(executor.map(check, entries))
+    printline(
+        "clang-tidy:",
+        *[f"{results.count(r)} {r}" for r in sorted(set(results))],
+    )
+    if "failed" in results:
+        raise Exception("clang-tidy failed")
+
+
+class TestHistory:
+    """
+    Persistent record of how long each of a package's tests took in recent
+    runs, per test variant (e.g. plain, valgrind, sanitize), used to start
+    the longest tests first and to derive timeouts.
+    """
+
+    # Number of recent durations kept per test
+    LENGTH = 5
+
+    # Factor by which a test may exceed its longest recorded duration
+    TIMEOUT_MARGIN = 3
+
+    def __init__(self, path):
+        """
+        Create new TestHistory.
+
+        Parameter descriptions:
+        path               Directory the history is stored in
+        """
+        self.path = path
+        self.lock = threading.Lock()
+        os.makedirs(self.path, exist_ok=True)
+
+    def _load(self, package):
+        try:
+            with open(os.path.join(self.path, package + ".json"), "r") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return dict()
+
+    def record(self, package, variant, durations):
+        """
+        Add the durations of a test run to the history.
+
+        Parameter descriptions:
+        package            Name of the package
+        variant            Name of the test variant
+        durations          List of (test name, duration in seconds) tuples
+        """
+        if not durations:
+            return
+        with self.lock:
+            history = self._load(package)
+            tests = history.setdefault(variant, dict())
+            for name, duration in durations:
+                recent = tests.setdefault(name, [])
+                recent.append(duration)
+                del recent[: -TestHistory.LENGTH]
+            entry = os.path.join(self.path, package + ".json")
+            partial = f"{entry}.{os.getpid()}.partial"
+            with open(partial, "w") as f:
+                json.dump(history, f)
+            os.replace(partial, entry)
+
+    def expected(self, package, variant):
+        """
+        Return dict of test names mapped to the longest recent duration.
+
+        Parameter descriptions:
+        package            Name of the package
+        variant            Name of the test variant
+        """
+        tests = self._load(package).get(variant, dict())
+        return {name: max(recent) for name, recent in tests.items()}
+
+
+class TestResultCache:
+    """
+    Persistent record of the meson tests that passed, keyed by what a test's
+    result depends on: its executable, the shared libraries it links, its
+    arguments, environment and working directory, the outputs of the targets
+    it depends on, its expected result, protocol and timeout, the toolchain,
+    and the variant (e.g. plain, valgrind, sanitize) and its meson test
+    arguments.
+
+    The key isn't hermetic: files which a test reads without them being
+    among its arguments or dependencies, e.g. data files in the source
+    tree, scripts run by a test script, or libraries loaded with dlopen(),
+    aren't covered. Reusing the results is therefore opt-in.
+    """
+
+    # Bump when the key derivation changes
+    VERSION = 2
+
+    def __init__(self, path):
+        """
+        Create new TestResultCache.
+
+        Parameter descriptions:
+        path               Directory the passing results are stored in
+        """
+        self.path = path
+        self.lock = threading.Lock()
+        self.digests = dict()
+        os.makedirs(self.path, exist_ok=True)
+
+    def _file_digest(self, path):
+        stat = os.stat(path)
+        memo = (path, stat.st_mtime_ns, stat.st_size)
+        with self.lock:
+            if memo in self.digests:
+                return self.digests[memo]
+        digest = hashlib.sha256()
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                digest.update(chunk)
+        with self.lock:
+            self.digests[memo] = digest.hexdigest()
+        return self.digests[memo]
+
+    def _libraries(self, path):
+        try:
+            output = subprocess.check_output(
+                ["ldd", path], stderr=subprocess.DEVNULL
+            ).decode("utf-8")
+        except (CalledProcessError, OSError):
+            # Not a dynamically linked executable, e.g. a script
+            return []
+        return sorted(
+            word
+            for line in output.splitlines()
+            for word in line.split()
+            if word.startswith("/") and os.path.isfile(word)
+        )
+
+    def keys(self, build_dir, variant, test_args):
+        """
+        Return dict of the logged names of the build directory's tests mapped
+        to (test name, cache key) tuples.
+
+        Parameter descriptions:
+        build_dir          The build directory the tests were built in
+        variant            Name of the test variant
+        test_args          List of additional arguments to meson test
+        """
+        datafile = os.path.join(
+            build_dir, "meson-private", "meson_test_setup.dat"
+        )
+        try:
+            with open(datafile, "rb") as f:
+                tests = pickle.load(f)
+        except Exception:
+            # Missing, or written by a meson version this one can't read,
+            # in which case every test runs
+            return dict()
+        base = hashlib.sha256()
+        for item in [
+            str(TestResultCache.VERSION),
+            TOOLCHAIN.fingerprint(),
+            variant,
+        ] + test_args:
+            base.update(item.encode("utf-8"))
+            base.update(b"\0")
+        try:
+            outputs = {
+                target["id"]: target["filename"]
+                for target in MESON_INFO.get(build_dir, "targets")
+            }
+        except OSError:
+            return dict()
+
+        keys = dict()
+        for test in tests:
+            digest = base.copy()
+            try:
+                env = sorted(test.env.get_env(dict()).items())
+                items = [test.name, repr(test.suite), repr(env)]
+                items += [
+                    str(test.workdir),
+                    str(test.expected_fail),
+                    str(test.expected_exitcode),
+                    str(test.protocol),
+                    str(test.timeout),
+                ]
+                depends = sorted(test.depends)
+                args = test.fname + test.cmd_args
+            except Exception:
+                # Environments which can't be resolved, or tests as another
+                # meson version serialises them, aren't cacheable
+                continue
+            for target in depends:
+                for output in outputs.get(target, []):
+                    items.append(output)
+                    if os.path.isfile(output):
+                        items.append(self._file_digest(output))
+            for arg in args:
+                items.append(arg)
+                if os.path.isabs(arg) and os.path.isfile(arg):
+                    items.append(self._file_digest(arg))
+                    for library in self._libraries(arg):
+                        items += [library, self._file_digest(library)]
+            for item in items:
+                digest.update(item.encode("utf-8"))
+                digest.update(b"\0")
+            keys[Meson._test_log_name(test)] = (test.name, digest.hexdigest())
+        return keys
+
+    def _entry(self, key):
+        return os.path.join(self.path, key[:2], key)
+
+    def passed(self, key):
+        """
+        Return whether a test with the given cache key passed before, and may
+        be reported as passing without running it.
+
+        Parameter descriptions:
+        key                The test's cache key
+        """
+        if not os.path.exists(self._entry(key)):
+            return False
+        os.utime(self._entry(key))
+        return True
+
+    def record(self, key):
+        """
+        Record that a test with the given cache key passed.
+
+        Parameter descriptions:
+        key                The test's cache key
+        """
+        os.makedirs(os.path.dirname(self._entry(key)), exist_ok=True)
+        with open(self._entry(key), "w"):
+            pass
+
+
+# Records each test's duration in its .trs file around automake's driver
+AUTOMAKE_DURATION_DRIVER = """#!/bin/sh
+start=$(date +%s%N)
+"$@"
+rc=$?
+end=$(date +%s%N)
+trs=
+prev=
+for arg in "$@"; do
+    if [ "$prev" = "--trs-file" ]; then
+        trs="$arg"
+    fi
+    prev="$arg"
+done
+if [ -n "$trs" ] && [ -f "$trs" ]; then
+    echo ":test-duration-ms: $(((end - start) / 1000000))" >>"$trs"
+fi
+exit $rc
+"""
+
+
+def automake_duration_args():
+    """
+    Returns make arguments wrapping automake's default test driver so that
+    each test's duration is appended to its .trs file. Returns an empty list
+    if the build tree uses a custom test driver, which the override would
+    replace.
+    """
+    default_driver = "$(SHELL) $(top_srcdir)/test-driver"
+    for makefile in find_file("Makefile", "."):
+        with open(makefile, "r") as f:
+            for line in f:
+                if not line.startswith("LOG_DRIVER ="):
+                    continue
+                if line.split("=", 1)[1].strip() != default_driver:
+                    return []
+
+    driver = os.path.join(TEST_HISTORY.path, "automake-duration-driver")
+    if not os.path.exists(driver):
+        partial = f"{driver}.{os.getpid()}.partial"
+        with open(partial, "w") as f:
+            f.write(AUTOMAKE_DURATION_DRIVER)
+        os.chmod(partial, 0o755)
+        os.replace(partial, driver)
+    return [f"LOG_DRIVER={driver} {default_driver}"]
+
+
+def record_automake_durations(package, variant, since):
+    """
+    Records the durations found in the .trs files of the automake tests run
+    since the given time.
+
+    Parameter descriptions:
+    package             Name of the package
+    variant             Name of the test variant
+    since               Time the test run started
+    """
+    durations = []
+    for root, _, files in os.walk("."):
+        for f in files:
+            if not f.endswith(".trs"):
+                continue
+            trs = os.path.join(root, f)
+            if os.path.getmtime(trs) < since:
+                continue
+            with open(trs, "r") as h:
+                for line in h:
+                    if line.startswith(":test-duration-ms:"):
+                        name = os.path.relpath(trs[: -len(".trs")])
+                        ms = int(line.split(":", 2)[2])
+                        durations.append((name, ms / 1000))
+    TEST_HISTORY.record(package, variant, durations)
 
 
-def maybe_make_valgrind():
+def maybe_make_valgrind(package=None):
     """
     Potentially runs the unit tests through valgrind for the package
     via `make check-valgrind`. If the package does not have valgrind testing
     then it just skips over this.
+
+    Parameter descriptions:
+    package             Name of the package to record test durations for
     """
     # Valgrind testing is currently broken by an aggressive strcmp optimization
     # that is inlined into optimized code for POWER by gcc 7+. Until we find
@@ -475,16 +2944,18 @@ def maybe_make_valgrind():
     if not make_target_exists("check-valgrind"):
         return
 
+    start = time.time()
     try:
         cmd = make_parallel + ["check-valgrind"]
+        if package:
+            cmd += automake_duration_args()
         check_call_cmd(*cmd, preexec_fn=valgrind_rlimit_nofile)
     except CalledProcessError:
-        for root, _, files in os.walk(os.getcwd()):
-            for f in files:
-                if re.search("test-suite-[a-z]+.log", f) is None:
-                    continue
-                check_call_cmd("cat", os.path.join(root, f))
+        print_automake_failures(os.getcwd())
         raise Exception("Valgrind tests failed")
+    finally:
+        if package:
+            record_automake_durations(package, "valgrind", start)
 
 
 def maybe_make_coverage():
@@ -525,6 +2996,9 @@ class BuildSystem(object):
         realpath = os.path.realpath(self.path)
         self.package = package if package else os.path.basename(realpath)
         self.build_for_testing = False
+        self.single_pass_coverage = False
+        # Hash of the inputs of the analysis in CHECKPOINTS, if resumable
+        self.checkpoint = None
 
     def probe(self):
         """Test if the build system driver can be applied to the package
@@ -566,6 +3040,25 @@ class BuildSystem(object):
         """
         raise NotImplementedError
 
+    def configured(self):
+        """Test if the package has a configured build tree
+
+        Return True if configure() has generated the build tree, so that it
+        may be reused when resuming a run.
+        """
+        raise NotImplementedError
+
+    def adopt_configuration(self, build_for_testing):
+        """Adopt the configuration of the existing build tree
+
+        Sets up the driver for the phases after configure() as configure()
+        would, without configuring the build tree again.
+
+        Keyword arguments:
+        build_for_testing: As for configure()
+        """
+        raise NotImplementedError
+
     def build(self):
         """Build the software ready for installation and/or testing
 
@@ -585,6 +3078,19 @@ class BuildSystem(object):
         """
         raise NotImplementedError
 
+    def stage(self, destdir):
+        """Install the software into a staging directory
+
+        Should raise an exception if installation fails
+
+        Unlike install(), stage() must not require elevated privileges or
+        modify the real prefix; the staged tree is later copied into place.
+
+        Keyword arguments:
+        destdir: The directory the installation prefix is created under
+        """
+        raise NotImplementedError
+
     def test(self):
         """Build and run the test suite associated with the package
 
@@ -636,15 +3142,23 @@ class Autotools(BuildSystem):
         with open(configure_ac, "rt") as f:
             contents += f.read()
 
+        scan_key = DEP_SCAN_CACHE.key("autotools", [contents])
+        found_deps = DEP_SCAN_CACHE.get(scan_key)
+        if found_deps is not None:
+            return found_deps
+
         autoconf_cmdline = ["autoconf", "-Wno-undefined", "-"]
-        autoconf_process = subprocess.Popen(
-            autoconf_cmdline,
-            stdin=subprocess.PIPE,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-        )
-        document = contents.encode("utf-8")
-        stdout, stderr = autoconf_process.communicate(input=document)
+        # autoconf leaves its autom4te.cache in the working directory
+        with TemporaryDirectory() as workdir:
+            autoconf_process = subprocess.Popen(
+                autoconf_cmdline,
+                stdin=subprocess.PIPE,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE,
+                cwd=workdir,
+            )
+            document = contents.encode("utf-8")
+            stdout, stderr = autoconf_process.communicate(input=document)
         if not stdout:
             print(stderr)
             raise Exception("Failed to run autoconf for parsing dependencies")
@@ -664,6 +3178,7 @@ class Autotools(BuildSystem):
                     if potential_dep.startswith(known_dep):
                         found_deps.append(DEPENDENCIES[macro][known_dep])
 
+        DEP_SCAN_CACHE.put(scan_key, found_deps)
         return found_deps
 
     def _configure_feature(self, flag, enabled):
@@ -676,8 +3191,14 @@ class Autotools(BuildSystem):
         """
         return "--" + ("enable" if enabled else "disable") + "-" + flag
 
-    def configure(self, build_for_testing):
+    def adopt_configuration(self, build_for_testing):
         self.build_for_testing = build_for_testing
+        self.single_pass_coverage = is_single_pass_coverage(
+            build_for_testing, ["lcov"]
+        )
+
+    def configure(self, build_for_testing):
+        self.adopt_configuration(build_for_testing)
         conf_flags = [
             self._configure_feature("silent-rules", False),
             self._configure_feature("examples", build_for_testing),
@@ -686,10 +3207,19 @@ class Autotools(BuildSystem):
         ]
         conf_flags.extend(
             [
-                self._configure_feature("code-coverage", False),
+                self._configure_feature(
+                    "code-coverage", self.single_pass_coverage
+                ),
                 self._configure_feature("valgrind", build_for_testing),
             ]
         )
+        if CCACHE:
+            conf_flags.extend(
+                [
+                    "CC=" + CCACHE.wrap(os.environ.get("CC", "gcc")),
+                    "CXX=" + CCACHE.wrap(os.environ.get("CXX", "g++")),
+                ]
+            )
         # Add any necessary configure flags for package
         if CONFIGURE_FLAGS.get(self.package) is not None:
             conf_flags.extend(CONFIGURE_FLAGS.get(self.package))
@@ -699,26 +3229,50 @@ class Autotools(BuildSystem):
                 break
         check_call_cmd("./configure", *conf_flags)
 
+    def configured(self):
+        return os.path.isfile(os.path.join(self.path, "Makefile"))
+
     def build(self):
         check_call_cmd(*make_parallel)
 
     def install(self):
-        check_call_cmd("sudo", "-n", "--", *(make_parallel + ["install"]))
+        check_call_cmd(*sudo_cmd(*make_parallel, "install"))
         check_call_cmd("sudo", "-n", "--", "ldconfig")
 
+    def stage(self, destdir):
+        check_call_cmd(*(make_parallel + ["install", "DESTDIR=" + destdir]))
+
     def test(self):
         try:
-            cmd = make_parallel + ["check"]
+            cmd = make_parallel + ["check"] + automake_duration_args()
             for i in range(0, args.repeat):
-                check_call_cmd(*cmd)
-
-            maybe_make_valgrind()
-            maybe_make_coverage()
+                start = time.time()
+                try:
+                    check_call_cmd(*cmd)
+                finally:
+                    record_automake_durations(self.package, "plain", start)
+
+            # Capture the coverage of the runs above rather than re-running
+            # the tests under check-code-coverage
+            if self.single_pass_coverage and make_target_exists(
+                "code-coverage-capture"
+            ):
+                check_call_cmd(*(make_parallel + ["code-coverage-capture"]))
+                tests = len(
+                    [
+                        f
+                        for _, _, files in os.walk(".")
+                        for f in files
+                        if f.endswith(".trs")
+                    ]
+                )
+                report_single_pass_savings(0, 1, tests)
+                maybe_make_valgrind(self.package)
+            else:
+                maybe_make_valgrind(self.package)
+                maybe_make_coverage()
         except CalledProcessError:
-            for root, _, files in os.walk(os.getcwd()):
-                if "test-suite.log" not in files:
-                    continue
-                check_call_cmd("cat", os.path.join(root, "test-suite.log"))
+            print_automake_failures(os.getcwd())
             raise Exception("Unit tests failed")
 
     def analyze(self):
@@ -735,8 +3289,11 @@ class CMake(BuildSystem):
     def dependencies(self):
         return []
 
-    def configure(self, build_for_testing):
+    def adopt_configuration(self, build_for_testing):
         self.build_for_testing = build_for_testing
+
+    def configure(self, build_for_testing):
+        self.adopt_configuration(build_for_testing)
         if INTEGRATION_TEST:
             check_call_cmd(
                 "cmake",
@@ -753,20 +3310,27 @@ class CMake(BuildSystem):
                 ".",
             )
 
+    def configured(self):
+        return os.path.isfile(os.path.join(self.path, "CMakeCache.txt"))
+
     def build(self):
         check_call_cmd(
             "cmake",
             "--build",
             ".",
             "--",
-            "-j",
-            str(multiprocessing.cpu_count()),
+            *parallel_args(BUILD_JOBS),
         )
 
     def install(self):
         check_call_cmd("sudo", "cmake", "--install", ".")
         check_call_cmd("sudo", "-n", "--", "ldconfig")
 
+    def stage(self, destdir):
+        stage_env = os.environ.copy()
+        stage_env["DESTDIR"] = destdir
+        check_call_cmd("cmake", "--install", ".", env=stage_env)
+
     def test(self):
         if make_target_exists("test"):
             check_call_cmd("ctest", ".")
@@ -784,25 +3348,98 @@ class CMake(BuildSystem):
                     "-B" + build_dir,
                 )
 
-                check_call_cmd(
-                    "run-clang-tidy", "-header-filter=.*", "-p", build_dir
-                )
+                if INCREMENTAL_CLANG_TIDY:
+                    run_clang_tidy(build_dir, available_cpus(), ".*")
+                else:
+                    check_call_cmd(
+                        "run-clang-tidy", "-header-filter=.*", "-p", build_dir
+                    )
 
         maybe_make_valgrind()
         maybe_make_coverage()
 
 
+class MesonInfo:
+    """
+    Reads what meson records about a configured build directory, i.e. the
+    meson-info/intro-*.json introspection files and the test setups, in
+    process rather than by running meson. The data is memoized per build
+    directory until meson regenerates it, e.g. when reconfiguring.
+    """
+
+    def __init__(self):
+        """
+        Create new MesonInfo.
+        """
+        self.lock = threading.Lock()
+        self.entries = dict()
+
+    def _memoize(self, build_dir, path, load):
+        path = os.path.join(build_dir, path)
+        stat = os.stat(path)
+        generation = (stat.st_ino, stat.st_size, stat.st_mtime_ns)
+        with self.lock:
+            entry = self.entries.get(os.path.realpath(path))
+        if entry and entry[0] == generation:
+            return entry[1]
+        value = load(path)
+        with self.lock:
+            self.entries[os.path.realpath(path)] = (generation, value)
+        return value
+
+    def get(self, build_dir, section):
+        """
+        Return the content of one of the build directory's introspection
+        files, raising OSError if it is not configured.
+
+        Parameter descriptions:
+        build_dir          The meson build directory
+        section            Name of the introspection data, e.g. projectinfo,
+                           tests, targets or buildoptions
+        """
+
+        def load(path):
+            with open(path, "r") as f:
+                return json.load(f)
+
+        return self._memoize(
+            build_dir,
+            os.path.join("meson-info", f"intro-{section}.json"),
+            load,
+        )
+
+    def test_setups(self, build_dir):
+        """
+        Return dict of the build directory's test setups, each named
+        <project>:<setup>, mapped to their timeout multipliers, raising
+        OSError if it is not configured.
+
+        Parameter descriptions:
+        build_dir          The meson build directory
+        """
+        return self._memoize(
+            build_dir,
+            os.path.join("meson-private", "build.dat"),
+            lambda path: {
+                name: setup.timeout_multiplier
+                for name, setup in meson_build_load(
+                    build_dir
+                ).test_setups.items()
+            },
+        )
+
+
+MESON_INFO = MesonInfo()
+
+
 class Meson(BuildSystem):
     @staticmethod
     def _project_name(path):
-        doc = subprocess.check_output(
-            ["meson", "introspect", "--projectinfo", path],
-            stderr=subprocess.STDOUT,
-        ).decode("utf-8")
-        return json.loads(doc)["descriptive_name"]
+        return MESON_INFO.get(path, "projectinfo")["descriptive_name"]
 
     def __init__(self, package=None, path=None):
         super(Meson, self).__init__(package, path)
+        self.affected_tests = None
 
     def probe(self):
         return os.path.isfile(os.path.join(self.path, "meson.build"))
@@ -812,12 +3449,28 @@ class Meson(BuildSystem):
         if not os.path.exists(meson_build):
             return []
 
-        found_deps = []
+        contents = []
         for root, dirs, files in os.walk(self.path):
+            # Neither git metadata nor meson build directories hold sources
+            if ".git" in dirs:
+                dirs.remove(".git")
+            if "meson-private" in dirs:
+                dirs[:] = []
+                continue
+            # The key mustn't depend on the filesystem's directory order
+            dirs.sort()
             if "meson.build" not in files:
                 continue
             with open(os.path.join(root, "meson.build"), "rt") as f:
-                build_contents = f.read()
+                contents.append(f.read())
+
+        scan_key = DEP_SCAN_CACHE.key("meson", contents)
+        found_deps = DEP_SCAN_CACHE.get(scan_key)
+        if found_deps is not None:
+            return found_deps
+
+        found_deps = []
+        for build_contents in contents:
             pattern = r"dependency\('([^']*)'.*?\),?"
             for match in re.finditer(pattern, build_contents):
                 group = match.group(1)
@@ -825,6 +3478,7 @@ class Meson(BuildSystem):
                 if maybe_dep is not None:
                     found_deps.append(maybe_dep)
 
+        DEP_SCAN_CACHE.put(scan_key, found_deps)
         return found_deps
 
     def _parse_options(self, options_file):
@@ -935,25 +3589,77 @@ class Meson(BuildSystem):
             meson_flags.extend(MESON_FLAGS.get(self.package))
         return meson_flags
 
+    def _setup(self, build_dir, meson_flags, env=None):
+        """
+        Configures the given build directory, reconfiguring it if it already
+        exists and starting afresh if that fails.
+
+        Parameter descriptions:
+        build_dir          The build directory to configure
+        meson_flags        List of flags to pass to meson setup
+        env                Environment to run meson in
+        """
+        if JOBSERVER:
+            # Link jobs take far more memory than compile jobs, so limit
+            # them to what the available memory admits
+            meson_flags = meson_flags + [
+                "-Dbackend_max_links=" + str(JOBSERVER.link_jobs())
+            ]
+        if OFFLINE:
+            # Subprojects missing from the wrap cache fail only if needed
+            meson_flags = meson_flags + ["--wrap-mode=nodownload"]
+        with contextlib.ExitStack() as stack:
+            if WRAP_CACHE:
+                env = dict(env or os.environ)
+                env["MESON_PACKAGE_CACHE_DIR"] = stack.enter_context(
+                    WRAP_CACHE.package_cache(self.path)
+                )
+            try:
+                check_call_cmd(
+                    "meson",
+                    "setup",
+                    "--reconfigure",
+                    build_dir,
+                    *meson_flags,
+                    env=env,
+                )
+            except Exception:
+                shutil.rmtree(build_dir, ignore_errors=True)
+                check_call_cmd(
+                    "meson", "setup", build_dir, *meson_flags, env=env
+                )
+
+    def adopt_configuration(self, build_for_testing):
+        self.build_for_testing = build_for_testing
+        self.single_pass_coverage = is_single_pass_coverage(
+            build_for_testing, ["gcovr", "lcov"]
+        )
+        self.package = Meson._project_name("build")
+
     def configure(self, build_for_testing):
         meson_flags = self.get_configure_flags(build_for_testing)
-        try:
-            check_call_cmd(
-                "meson", "setup", "--reconfigure", "build", *meson_flags
-            )
-        except Exception:
-            shutil.rmtree("build", ignore_errors=True)
-            check_call_cmd("meson", "setup", "build", *meson_flags)
+        self.single_pass_coverage = is_single_pass_coverage(
+            build_for_testing, ["gcovr", "lcov"]
+        )
+        if self.single_pass_coverage:
+            meson_flags.append("-Db_coverage=true")
+        self._setup("build", meson_flags)
 
-        self.package = Meson._project_name("build")
+        self.adopt_configuration(build_for_testing)
+
+    def configured(self):
+        return os.path.isfile(os.path.join("build", "build.ninja"))
 
     def build(self):
-        check_call_cmd("ninja", "-C", "build")
+        check_call_cmd("ninja", "-C", "build", *parallel_args(BUILD_JOBS))
 
     def install(self):
-        check_call_cmd("sudo", "-n", "--", "ninja", "-C", "build", "install")
+        check_call_cmd(*sudo_cmd("ninja", "-C", "build", "install"))
         check_call_cmd("sudo", "-n", "--", "ldconfig")
 
+    def stage(self, destdir):
+        check_call_cmd("meson", "install", "-C", "build", "--destdir", destdir)
+
     def test(self):
         # It is useful to check various settings of the meson.build file
         # for compatibility, such as meson_version checks.  We shouldn't
@@ -963,13 +3669,321 @@ class Meson(BuildSystem):
         # this check without our control).
         self._extra_meson_checks()
 
+        # Coverage has to be collected from the full suite
+        if AFFECTED_TESTS and not self.single_pass_coverage:
+            self.affected_tests = self._affected_tests("build")
+
         try:
-            test_args = ("--repeat", str(args.repeat), "-C", "build")
-            check_call_cmd("meson", "test", "--print-errorlogs", *test_args)
+            test_args = ["--repeat", str(args.repeat)]
+            # Coverage has to be collected from running every test
+            self._run_tests(
+                "build",
+                "plain",
+                test_args,
+                tests=self.affected_tests,
+                cache_results=not self.single_pass_coverage,
+            )
 
         except CalledProcessError:
             raise Exception("Unit tests failed")
 
+        if self.single_pass_coverage:
+            self._coverage_report("build")
+            report_single_pass_savings(
+                1, args.repeat, self._test_count("build") * args.repeat
+            )
+
+    def _affected_tests(self, build_dir):
+        """
+        Returns the names of the tests depending on the files changed by the
+        commit under test according to the build graph and ninja's dependency
+        log, or None if the full suite has to run.
+
+        Parameter descriptions:
+        build_dir          The build directory the tests were built in
+        """
+        changed = changed_files(".")
+        if changed is None:
+            print("Running all tests, the changed files are unknown")
+            return None
+        if any(os.path.basename(f) in BUILD_FILES for f in changed):
+            print("Running all tests, the change touches build files")
+            return None
+
+        def resolve(path):
+            return os.path.realpath(os.path.join(build_dir, path))
+
+        def ninja_tool(*tool_args):
+            return subprocess.check_output(
+                ["ninja", "-C", build_dir, "-t", *tool_args],
+                stderr=subprocess.DEVNULL,
+            ).decode("utf-8")
+
+        try:
+            targets = MESON_INFO.get(build_dir, "targets")
+            intro_tests = MESON_INFO.get(build_dir, "tests")
+            # The sources and headers each object was last compiled from
+            objects = dict()
+            deps = set()
+            for line in ninja_tool("deps").splitlines():
+                if line.startswith(" "):
+                    deps.add(resolve(line.strip()))
+                elif line:
+                    deps = set()
+                    objects[resolve(line.rsplit(": #deps", 1)[0])] = deps
+
+            outputs = {
+                resolve(f): t["id"] for t in targets for f in t["filename"]
+            }
+            target_outputs = dict()
+            for output, target_id in outputs.items():
+                target_outputs.setdefault(target_id, []).append(output)
+
+            closures = dict()
+
+            def closure(output):
+                # All files the output is built from, including headers
+                if output not in closures:
+                    files = {output}
+                    inputs = ninja_tool(
+                        "inputs", os.path.relpath(output, build_dir)
+                    )
+                    for path in map(resolve, inputs.splitlines()):
+                        files.add(path)
+                        files |= objects.get(path, set())
+                    closures[output] = files
+                return closures[output]
+
+            known = set().union(*objects.values())
+            affected = []
+            for test in intro_tests:
+                files = {
+                    os.path.realpath(a) for a in test["cmd"] if a[:1] == "/"
+                }
+                for output in [f for f in files if f in outputs] + [
+                    o
+                    for d in test["depends"]
+                    for o in target_outputs.get(d, [])
+                ]:
+                    files |= closure(output)
+                known |= files
+                if files & changed and test["name"] not in affected:
+                    affected.append(test["name"])
+        except (CalledProcessError, OSError, ValueError, KeyError):
+            print("Running all tests, the build graph can't be introspected")
+            return None
+
+        # Changes outside the build graph, e.g. to test data, may affect any
+        # test, except for documentation
+        if any(
+            f not in known and not f.endswith((".md", ".rst")) for f in changed
+        ):
+            print(
+                "Running all tests, the change touches files outside the build"
+            )
+            return None
+        print(
+            f"Running {len(affected)} of {len(intro_tests)} tests affected"
+            " by the change"
+        )
+        return affected
+
+    def _test_count(self, build_dir):
+        """
+        Returns the number of tests defined in the build directory.
+
+        Parameter descriptions:
+        build_dir          The build directory to count the tests of
+        """
+        try:
+            return len(MESON_INFO.get(build_dir, "tests"))
+        except (OSError, ValueError):
+            return 0
+
+    def _coverage_report(self, build_dir):
+        """
+        Generates the coverage report if coverage files were produced.
+
+        Parameter descriptions:
+        build_dir          The coverage instrumented build directory
+        """
+        for root, dirs, files in os.walk(build_dir):
+            if any([f.endswith(".gcda") for f in files]):
+                check_call_cmd("ninja", "-C", build_dir, "coverage-html")
+                break
+
+    @staticmethod
+    def _test_log_name(test):
+        """
+        Returns the name meson test logs the serialised test under.
+
+        Parameter descriptions:
+        test               The test's TestSerialisation
+        """
+        project = test.suite[0].split(":", 1)[0]
+        suites = [s.split(":", 1)[1] for s in test.suite if ":" in s]
+        name = f"{project}:{test.name}"
+        if any(suites):
+            name = "+".join(s for s in suites if s) + " - " + name
+        return name
+
+    def _order_tests(self, build_dir, variant):
+        """
+        Reorders the build directory's serialised tests so that, within each
+        priority, meson starts the tests with the longest recorded durations
+        first. This rewrites meson's private meson_test_setup.dat, hence is
+        only done with ORDER_TESTS. Returns the timeout multiplier needed for
+        every test to finish within TestHistory.TIMEOUT_MARGIN times its
+        longest recorded duration, or None if some test has no recorded
+        duration.
+
+        Parameter descriptions:
+        build_dir          The build directory to run the tests in
+        variant            Name of the test variant
+        """
+        datafile = os.path.join(
+            build_dir, "meson-private", "meson_test_setup.dat"
+        )
+        try:
+            with open(datafile, "rb") as f:
+                tests = pickle.load(f)
+        except OSError:
+            return None
+        durations = TEST_HISTORY.expected(self.package, variant)
+        expected = {
+            id(t): durations.get(Meson._test_log_name(t)) for t in tests
+        }
+        tests.sort(key=lambda t: (-t.priority, -(expected[id(t)] or 0)))
+        partial = f"{datafile}.{os.getpid()}.partial"
+        with open(partial, "wb") as f:
+            pickle.dump(tests, f)
+        os.replace(partial, datafile)
+
+        if None in expected.values():
+            return None
+        ratios = [expected[id(t)] / t.timeout for t in tests if t.timeout]
+        return max(
+            1, math.ceil(TestHistory.TIMEOUT_MARGIN * max(ratios, default=0))
+        )
+
+    @staticmethod
+    def _setup_timeout_multiplier(build_dir, test_args):
+        """
+        Returns the timeout multiplier of the test setup selected by the
+        meson test arguments, 1 if there is none.
+
+        Parameter descriptions:
+        build_dir          The build directory to run the tests in
+        test_args          List of additional arguments to meson test
+        """
+        if "--setup" not in test_args:
+            return 1
+        setup = test_args[test_args.index("--setup") + 1]
+        try:
+            return MESON_INFO.test_setups(build_dir).get(setup, 1)
+        except OSError:
+            return 1
+
+    def _run_tests(
+        self,
+        build_dir,
+        variant,
+        test_args,
+        logbase="testlog",
+        timeout_multiplier=None,
+        jobs=None,
+        tests=None,
+        cache_results=False,
+        **kwargs,
+    ):
+        """
+        Runs meson test, and records the durations. With ORDER_TESTS the
+        tests run longest-first as ordered by the test history, with a
+        timeout multiplier derived from it.
+
+        Parameter descriptions:
+        build_dir          The build directory to run the tests in
+        variant            Name of the test variant
+        test_args          List of additional arguments to meson test
+        logbase            Base name of the test log meson writes
+        timeout_multiplier Timeout multiplier to use if there is no history
+        jobs               Number of tests to run concurrently, as many as
+                           the job slots allow if None
+        tests              List of names of the tests to run, all if None
+        cache_results      Whether to skip the tests which passed before with
+                           identical inputs, and to record those passing
+        kwargs             Additional arguments to check_call_cmd
+        """
+        results = dict()
+        if cache_results and TEST_RESULTS:
+            results = TEST_RESULTS.keys(build_dir, variant, test_args)
+            if tests is not None:
+                results = {
+                    log_name: (name, key)
+                    for log_name, (name, key) in results.items()
+                    if name in tests
+                }
+            cached = {
+                log_name
+                for log_name, (_, key) in results.items()
+                if TEST_RESULTS.passed(key)
+            }
+            for log_name in sorted(cached):
+                print(f"{log_name}: {variant} test result cached")
+            if cached:
+                # Tests sharing a name can only be selected together
+                tests = list(
+                    dict.fromkeys(
+                        name
+                        for log_name, (name, _) in results.items()
+                        if log_name not in cached
+                    )
+                )
+        if tests is not None:
+            if not tests:
+                print(f"No {variant} tests to run")
+                return
+            test_args = test_args + tests
+        multiplier = timeout_multiplier
+        if ORDER_TESTS:
+            derived = self._order_tests(build_dir, variant)
+            # A multiplier of 0 or less disables the timeouts altogether
+            floor = self._setup_timeout_multiplier(build_dir, test_args)
+            if derived is not None and floor > 0:
+                # The test setup's multiplier accounts for e.g. valgrind
+                multiplier = max(derived, floor, timeout_multiplier or 1)
+        cmd = ["meson", "test", "-C", build_dir] + test_args
+        if not LOGS.enabled:
+            cmd.append("--print-errorlogs")
+        if multiplier:
+            cmd += ["-t", str(multiplier)]
+        testlog = os.path.join(build_dir, "meson-logs", logbase + ".json")
+        # Results of a previous run must not be mistaken for this run's
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(testlog)
+        try:
+            with job_slots(jobs) as slots:
+                check_call_cmd(*cmd, "--num-processes", str(slots), **kwargs)
+        finally:
+            durations = []
+            passed = set()
+            failed = set()
+            if os.path.exists(testlog):
+                with open(testlog, "r") as f:
+                    for line in f:
+                        result = json.loads(line)
+                        durations.append((result["name"], result["duration"]))
+                        if result["result"] == "OK":
+                            passed.add(result["name"])
+                        else:
+                            failed.add(result["name"])
+                if LOGS.enabled:
+                    print_meson_failures(testlog)
+            TEST_HISTORY.record(self.package, variant, durations)
+            for log_name in passed - failed:
+                if log_name in results:
+                    TEST_RESULTS.record(results[log_name][1])
+
     def _setup_exists(self, setup):
         """
         Returns whether the meson build supports the named test setup.
@@ -977,6 +3991,13 @@ class Meson(BuildSystem):
         Parameter descriptions:
         setup              The setup target to check
         """
+        try:
+            setups = MESON_INFO.test_setups("build")
+            return "{}:{}".format(self.package, setup) in setups
+        except Exception:
+            # The build data can't be loaded, e.g. if it was written by
+            # another meson version, so ask meson itself
+            pass
         try:
             with open(os.devnull, "w"):
                 output = subprocess.check_output(
@@ -996,136 +4017,250 @@ class Meson(BuildSystem):
         output = output.decode("utf-8")
         return not re.search("Unknown test setup '[^']+'[.]", output)
 
-    def _maybe_valgrind(self):
+    def _maybe_valgrind(self, jobs=None):
         """
         Potentially runs the unit tests through valgrind for the package
         via `meson test`. The package can specify custom valgrind
         configurations by utilizing add_test_setup() in a meson.build
+
+        Parameter descriptions:
+        jobs               Number of tests to run concurrently
         """
         if not is_valgrind_safe():
             sys.stderr.write("###### Skipping valgrind ######\n")
             return
+        test_args = []
         try:
             if self._setup_exists("valgrind"):
-                check_call_cmd(
-                    "meson",
-                    "test",
-                    "-t",
-                    "10",
-                    "-C",
+                setup = "{}:valgrind".format(self.package)
+                self._run_tests(
                     "build",
-                    "--print-errorlogs",
-                    "--setup",
-                    "{}:valgrind".format(self.package),
+                    "valgrind",
+                    test_args + ["--setup", setup],
+                    logbase="testlog-" + setup.replace(":", "_"),
+                    timeout_multiplier=10,
+                    jobs=jobs,
+                    tests=self.affected_tests,
+                    cache_results=True,
                     preexec_fn=valgrind_rlimit_nofile,
                 )
             else:
-                check_call_cmd(
-                    "meson",
-                    "test",
-                    "-t",
-                    "10",
-                    "-C",
+                self._run_tests(
                     "build",
-                    "--print-errorlogs",
-                    "--wrapper",
-                    "valgrind --error-exitcode=1",
+                    "valgrind",
+                    test_args + ["--wrapper", "valgrind --error-exitcode=1"],
+                    logbase="testlog-valgrind",
+                    timeout_multiplier=10,
+                    jobs=jobs,
+                    tests=self.affected_tests,
+                    cache_results=True,
                     preexec_fn=valgrind_rlimit_nofile,
                 )
         except CalledProcessError:
             raise Exception("Valgrind tests failed")
 
-    def analyze(self):
-        self._maybe_valgrind()
+    @staticmethod
+    def _clang_env():
+        """
+        Returns the environment of the clang-specific build directory.
+        """
+        clang_env = os.environ.copy()
+        clang_env["CC"] = "clang"
+        clang_env["CXX"] = "clang++"
+        # Compilers given through the environment aren't wrapped by meson
+        if CCACHE:
+            clang_env["CC"] = CCACHE.wrap(clang_env["CC"])
+            clang_env["CXX"] = CCACHE.wrap(clang_env["CXX"])
+        # Clang-20 currently has some issue with libstdcpp's
+        # std::forward_like which results in a bunch of compile errors.
+        # Adding -fno-builtin-std-forward_like causes them to go away.
+        clang_env["CXXFLAGS"] = "-fno-builtin-std-forward_like"
+        clang_env["CC_LD"] = "lld"
+        clang_env["CXX_LD"] = "lld"
+        return clang_env
+
+    def _clang_tidy(self, jobs):
+        """
+        Builds the package in a clang-specific build directory, and runs
+        clang-tidy over it if it is run incrementally. Otherwise clang-tidy
+        runs in _clang_tidy_fix() once the concurrent variants completed.
 
-        # Run clang-tidy only if the project has a configuration
-        if os.path.isfile(".clang-tidy"):
-            clang_env = os.environ.copy()
-            clang_env["CC"] = "clang"
-            clang_env["CXX"] = "clang++"
-            # Clang-20 currently has some issue with libstdcpp's
-            # std::forward_like which results in a bunch of compile errors.
-            # Adding -fno-builtin-std-forward_like causes them to go away.
-            clang_env["CXXFLAGS"] = "-fno-builtin-std-forward_like"
-            clang_env["CC_LD"] = "lld"
-            clang_env["CXX_LD"] = "lld"
-            with TemporaryDirectory(prefix="build", dir=".") as build_dir:
-                check_call_cmd("meson", "setup", build_dir, env=clang_env)
-                if not os.path.isfile(".openbmc-no-clang"):
-                    check_call_cmd(
-                        "meson", "compile", "-C", build_dir, env=clang_env
-                    )
-                try:
-                    check_call_cmd(
-                        "ninja",
-                        "-C",
-                        build_dir,
-                        "clang-tidy-fix",
-                        env=clang_env,
-                    )
-                except subprocess.CalledProcessError:
-                    check_call_cmd(
-                        "git",
-                        "-C",
-                        CODE_SCAN_DIR,
-                        "--no-pager",
-                        "diff",
-                        env=clang_env,
-                    )
-                    raise
-        # Run the basic clang static analyzer otherwise
-        else:
-            check_call_cmd("ninja", "-C", "build", "scan-build")
+        Parameter descriptions:
+        jobs               Number of build jobs to run concurrently
+        """
+        build_dir = "build-clang"
+        clang_env = Meson._clang_env()
+        self._setup(build_dir, [], env=clang_env)
+        if not os.path.isfile(".openbmc-no-clang"):
+            check_call_cmd(
+                "meson",
+                "compile",
+                "-C",
+                build_dir,
+                *parallel_args(jobs),
+                env=clang_env,
+            )
+        if INCREMENTAL_CLANG_TIDY:
+            run_clang_tidy(build_dir, jobs)
 
-        # Run tests through sanitizers
+    def _clang_tidy_fix(self, jobs):
+        """
+        Runs clang-tidy over the package built by _clang_tidy() and applies
+        its fixes. The fixes rewrite the sources in place, so this must not
+        run concurrently with any build of them.
+
+        Parameter descriptions:
+        jobs               Number of build jobs to run concurrently
+        """
+        build_dir = "build-clang"
+        clang_env = Meson._clang_env()
+        try:
+            check_call_cmd(
+                "ninja",
+                "-C",
+                build_dir,
+                *parallel_args(jobs),
+                "clang-tidy-fix",
+                env=clang_env,
+            )
+        except subprocess.CalledProcessError:
+            # The suggested fixes belong on the console, not in the phase log
+            sys.stdout.flush()
+            check_call_cmd(
+                "git",
+                "-C",
+                CODE_SCAN_DIR,
+                "--no-pager",
+                "diff",
+                env=clang_env,
+                stdout=sys.stdout,
+            )
+            raise
+
+    def _scan_build(self, jobs):
+        """
+        Runs the basic clang static analyzer over the package, from a build
+        directory of its own so as not to drive ninja in the build directory
+        the tests run in meanwhile.
+
+        Parameter descriptions:
+        jobs               Unused, scan-build manages its own build
+        """
+        build_dir = "build-scan"
+        self._setup(
+            build_dir, self.get_configure_flags(self.build_for_testing)
+        )
+        check_call_cmd("ninja", "-C", build_dir, "scan-build")
+
+    def _sanitize(self, jobs):
+        """
+        Runs the unit tests through the address and undefined behaviour
+        sanitizers in a dedicated build directory.
+
+        Parameter descriptions:
+        jobs               Number of build and test jobs to run concurrently
+        """
+        build_dir = "build-sanitize"
         # b_lundef is needed if clang++ is CXX since it resolves the
         # asan symbols at runtime only. We don't want to set it earlier
         # in the build process to ensure we don't have undefined
         # runtime code.
-        if is_sanitize_safe():
-            meson_flags = self.get_configure_flags(self.build_for_testing)
-            meson_flags.append("-Db_sanitize=address,undefined")
-            try:
-                check_call_cmd(
-                    "meson", "setup", "--reconfigure", "build", *meson_flags
-                )
-            except Exception:
-                shutil.rmtree("build", ignore_errors=True)
-                check_call_cmd("meson", "setup", "build", *meson_flags)
-            check_call_cmd(
-                "meson",
-                "test",
-                "-C",
-                "build",
-                "--print-errorlogs",
-                "--logbase",
-                "testlog-ubasan",
+        meson_flags = self.get_configure_flags(self.build_for_testing)
+        meson_flags.append("-Db_sanitize=address,undefined")
+        self._setup(build_dir, meson_flags)
+        check_call_cmd("ninja", "-C", build_dir, *parallel_args(jobs))
+        self._run_tests(
+            build_dir,
+            "sanitize",
+            ["--logbase", "testlog-ubasan"],
+            logbase="testlog-ubasan",
+            jobs=jobs,
+            tests=self.affected_tests,
+            cache_results=True,
+        )
+
+    def _coverage(self, jobs):
+        """
+        Runs the unit tests with coverage instrumentation in a dedicated build
+        directory and generates the coverage report.
+
+        Parameter descriptions:
+        jobs               Number of build and test jobs to run concurrently
+        """
+        build_dir = "build-coverage"
+        meson_flags = self.get_configure_flags(self.build_for_testing)
+        meson_flags.append("-Db_coverage=true")
+        self._setup(build_dir, meson_flags)
+        check_call_cmd("ninja", "-C", build_dir, *parallel_args(jobs))
+        try:
+            self._run_tests(
+                build_dir,
+                "coverage",
+                ["--repeat", str(args.repeat)],
+                jobs=jobs,
             )
-            meson_flags = [
-                s.replace(
-                    "-Db_sanitize=address,undefined", "-Db_sanitize=none"
-                )
-                for s in meson_flags
-            ]
-            try:
-                check_call_cmd(
-                    "meson", "setup", "--reconfigure", "build", *meson_flags
-                )
-            except Exception:
-                shutil.rmtree("build", ignore_errors=True)
-                check_call_cmd("meson", "setup", "build", *meson_flags)
+        except CalledProcessError:
+            raise Exception("Unit tests failed")
+        self._coverage_report(build_dir)
+
+    def analyze(self):
+        # Each analysis variant has its own persistent build directory so
+        # that none of them invalidate the main build or each other, and the
+        # variants share the CPUs while running concurrently.
+        variants = [self._maybe_valgrind]
+        # Variants modifying the sources run once the others completed
+        serial = []
+        # Run clang-tidy only if the project has a configuration
+        if os.path.isfile(".clang-tidy"):
+            variants.append(self._clang_tidy)
+            if not INCREMENTAL_CLANG_TIDY:
+                serial.append(self._clang_tidy_fix)
+        # Run the basic clang static analyzer otherwise
+        else:
+            variants.append(self._scan_build)
+        # Run tests through sanitizers
+        if is_sanitize_safe():
+            variants.append(self._sanitize)
         else:
             sys.stderr.write("###### Skipping sanitizers ######\n")
-
-        # Run coverage checks
-        check_call_cmd("meson", "configure", "build", "-Db_coverage=true")
-        self.test()
-        # Only build coverage HTML if coverage files were produced
-        for root, dirs, files in os.walk("build"):
-            if any([f.endswith(".gcda") for f in files]):
-                check_call_cmd("ninja", "-C", "build", "coverage-html")
-                break
-        check_call_cmd("meson", "configure", "build", "-Db_coverage=false")
+        # Run coverage checks, unless collected by the plain test run
+        if not self.single_pass_coverage:
+            variants.append(self._coverage)
+
+        # Populate the toolchain probe results before any concurrent use
+        is_valgrind_safe()
+        if JOBSERVER:
+            # The variants share the job slots as they become free
+            jobs = JOBSERVER.slots
+        else:
+            jobs = max(1, available_cpus() // len(variants))
+
+        def run_variant(variant, jobs):
+            name = f"{self.package}: analyze {variant.__name__.strip('_')}"
+            key = None
+            if self.checkpoint:
+                key = CHECKPOINTS.key(self.checkpoint, name)
+                if CHECKPOINTS.done(name, key):
+                    return
+            with TRACER.span(name):
+                variant(jobs)
+            if key:
+                CHECKPOINTS.record(name, key)
+
+        with concurrent.futures.ThreadPoolExecutor(len(variants)) as executor:
+            futures = [executor.submit(run_variant, v, jobs) for v in variants]
+        failures = [f.exception() for f in futures if f.exception()]
+        for variant in serial:
+            try:
+                run_variant(
+                    variant, JOBSERVER.slots if JOBSERVER else available_cpus()
+                )
+            except Exception as e:
+                failures.append(e)
+        for failure in failures:
+            sys.stderr.write(f"###### Analysis failed: {failure} ######\n")
+        if failures:
+            raise failures[0]
 
     def _extra_meson_checks(self):
         with open(os.path.join(self.path, "meson.build"), "rt") as f:
@@ -1204,25 +4339,357 @@ class Package(object):
 
         return next(iter(systems))
 
-    def install(self, system=None):
+    def install(self, system=None, cache_key=None):
         if not system:
             system = self.build_system()
 
-        system.configure(False)
-        system.build()
-        system.install()
+        with TRACER.span(f"{system.package}: configure"):
+            system.configure(False)
+        with TRACER.span(f"{system.package}: build"):
+            system.build()
+        with TRACER.span(f"{system.package}: install"):
+            with TemporaryDirectory(
+                prefix=f"stage-{system.package}-"
+            ) as staging_dir:
+                system.stage(staging_dir)
+                if cache_key:
+                    # Keep the staged tree so later runs can reuse it
+                    ARTIFACT_CACHE.store(cache_key, staging_dir)
+                merge_staged(staging_dir)
+
+    def _test_one(self, system, checkpoint=None, install=True):
+        if checkpoint:
+            checkpoint = CHECKPOINTS.key(checkpoint, type(system).__name__)
+        system.checkpoint = checkpoint
+        # The build tree can only be reused while it is still there
+        configured = system.configured()
+
+        def run_phase(phase, action, *args):
+            name = f"{system.package}: {phase}"
+            key = CHECKPOINTS.key(checkpoint, phase) if checkpoint else None
+            if (configured or phase not in ["configure", "build"]) and (
+                CHECKPOINTS.done(name, key)
+            ):
+                return False
+            with TRACER.span(name), compiler_cache_phase(phase), LOGS.phase(
+                name
+            ):
+                action(*args)
+            CHECKPOINTS.record(name, key)
+            return True
 
-    def _test_one(self, system):
-        system.configure(True)
-        system.build()
-        system.install()
-        system.test()
+        def locked_install():
+            # Packages tested concurrently install into the same prefix
+            with INSTALL_LOCK:
+                system.install()
+
+        if not run_phase("configure", system.configure, True):
+            system.adopt_configuration(True)
+        run_phase("build", system.build)
+        if install:
+            run_phase("install", locked_install)
+        run_phase("test", system.test)
         if not TEST_ONLY:
-            system.analyze()
+            run_phase("analyze", system.analyze)
 
-    def test(self):
+    def test(self, checkpoint=None, install=True):
         for system in self.build_systems():
-            self._test_one(system)
+            self._test_one(system, checkpoint, install)
+
+
+def format_code(name):
+    """
+    Runs format-code.sh, which will in turn call any repo-level formatters,
+    and fails if it changed any files.
+
+    Parameter descriptions:
+    name                The name of the package to format
+    """
+    if not FORMAT_CODE:
+        return
+    pkgdir = os.path.join(WORKSPACE, name)
+    format_script = os.path.join(
+        WORKSPACE, "openbmc-build-scripts", "scripts", "format-code.sh"
+    )
+    with open(format_script, "r") as f:
+        format_key = CHECKPOINTS.key(
+            "format-code", f.read(), tree_fingerprint(pkgdir)
+        )
+    if CHECKPOINTS.done(f"{name}: format-code", format_key):
+        return
+    with TRACER.span(f"{name}: format-code"):
+        check_call_cmd(format_script, pkgdir)
+
+        # Check to see if any files changed
+        check_call_cmd(
+            "git", "-C", pkgdir, "--no-pager", "diff", "--exit-code"
+        )
+    CHECKPOINTS.record(f"{name}: format-code", format_key)
+
+
+def discover_dependencies(dep_graph, names, failures=None):
+    """
+    Adds the packages and their dependencies to the dependency graph, with
+    the ordering constraints between the dependencies applied.
+
+    Parameter descriptions:
+    dep_graph           Dependency graph to record the dependencies in
+    names               Names of the packages checked out in the workspace
+    failures            Dict to record the packages whose dependencies can't
+                        be determined in, mapped to the error, rather than
+                        raising it. Such packages are dropped from the graph.
+    """
+
+    raise_errors = failures is None
+    failures = dict() if raise_errors else failures
+
+    def fail(name, e):
+        if raise_errors:
+            raise e
+        traceback.print_exc()
+        failures[name] = e
+        dep_graph.nodes[dep_graph.name].pop(name, None)
+
+    with TRACER.span("dependency discovery"):
+        for name in names:
+            try:
+                build_dep_tree(
+                    name,
+                    os.path.join(WORKSPACE, name),
+                    dep_graph,
+                    BRANCH,
+                    JOBS,
+                )
+            except Exception as e:
+                fail(name, e)
+        # Cyclic dependencies only fail the packages requiring them
+        for name in names:
+            if name in failures:
+                continue
+            try:
+                dep_graph.GetInstallList(name)
+            except Exception as e:
+                fail(name, e)
+    printline(
+        "Dependency scan cache:",
+        DEP_SCAN_CACHE.hits,
+        "hits,",
+        DEP_SCAN_CACHE.misses,
+        "misses",
+    )
+
+    # Packages only required through edges dropped by a rescan mustn't be
+    # constrained back into the install list
+    dep_graph.Prune()
+
+    # Apply ordering constraints between dependencies
+    for pkg_name, regex_str in DEPENDENCIES_REGEX.items():
+        dep_graph.AddOrderingConstraint(pkg_name, regex_str)
+    if args.verbose:
+        dep_graph.PrintTree()
+
+
+def test_checkpoint(name, dep_checkpoints):
+    """
+    Returns the hash of the inputs of testing a package in CHECKPOINTS.
+
+    Parameter descriptions:
+    name                The name of the package
+    dep_checkpoints     Hashes of the installs of the package's dependencies
+    """
+    # The outcome of testing depends on the options affecting what runs
+    return CHECKPOINTS.key(
+        "test",
+        name,
+        tree_fingerprint(os.path.join(WORKSPACE, name)),
+        json.dumps(MESON_FLAGS.get(name)),
+        json.dumps(CONFIGURE_FLAGS.get(name)),
+        json.dumps(
+            [
+                INTEGRATION_TEST,
+                args.repeat,
+                SINGLE_PASS,
+                AFFECTED_TESTS,
+                INCREMENTAL_CLANG_TIDY,
+            ]
+        ),
+        *sorted(dep_checkpoints),
+    )
+
+
+def run_ci_scripts(pkgdir):
+    """
+    Runs any custom CI scripts the repo has, of which there can be
+    multiple of and anywhere in the repository.
+
+    Parameter descriptions:
+    pkgdir              Directory of the package
+    """
+    ci_scripts = find_file(["run-ci.sh", "run-ci"], pkgdir)
+    if ci_scripts:
+        os.chdir(pkgdir)
+        for ci_script in ci_scripts:
+            with TRACER.span(os.path.relpath(ci_script, pkgdir)):
+                check_call_cmd(ci_script)
+
+
+def test_batch_package(name, checkpoint, log, umask, install):
+    """
+    Tests one package of a batch in a forked worker, writing the output to a
+    log. Returns the result of the package in the batch report.
+
+    Parameter descriptions:
+    name                The name of the package
+    checkpoint          Hash of the package's inputs in CHECKPOINTS
+    log                 Path of the package's log
+    umask               The umask to format and run CI scripts with
+    install             Whether to install the package built for testing
+    """
+    global UNIT_TEST_PKG, CODE_SCAN_DIR
+    UNIT_TEST_PKG = name
+    CODE_SCAN_DIR = os.path.join(WORKSPACE, name)
+    sys.stdout.flush()
+    sys.stderr.flush()
+    with open(log, "w") as f:
+        os.dup2(f.fileno(), sys.stdout.fileno())
+        os.dup2(f.fileno(), sys.stderr.fileno())
+
+    start = time.time()
+    result = {"result": "passed", "log": log}
+    try:
+        os.umask(umask)
+        format_code(name)
+        os.umask(000)
+        with TRACER.span(f"{name}: unit test"):
+            build_and_install(
+                name, True, checkpoint=checkpoint, install=install
+            )
+        os.umask(umask)
+        run_ci_scripts(CODE_SCAN_DIR)
+    except Exception as e:
+        traceback.print_exc()
+        result.update(result="failed", error=str(e))
+    result["duration"] = round(time.time() - start, 1)
+    return result
+
+
+def test_batch(names, report):
+    """
+    Tests several packages against a single install of the union of their
+    dependencies, running the packages' tests and analyses concurrently
+    with the CPUs shared through the jobserver, or one package at a time
+    without it. Packages under test which others depend on keep the
+    install their dependents build against rather than being installed
+    configured for testing. Writes a JSON report of the packages' results
+    and returns the exit status.
+
+    Parameter descriptions:
+    names               Names of the packages checked out in the workspace
+    report              Path of the report
+    """
+    results = dict()
+    tested = []
+    for name in names:
+        if Package(name, os.path.join(WORKSPACE, name)).build_system():
+            tested.append(name)
+        else:
+            results[name] = {"result": "skipped", "error": "No build system"}
+
+    # The packages hang off a root which isn't a package itself
+    root = "<batch>"
+    dep_graph = DepGraph(root)
+    for name in tested:
+        dep_graph.AddEdge(root, name)
+    failures = dict()
+    discover_dependencies(dep_graph, tested, failures)
+    for name, e in failures.items():
+        results[name] = {
+            "result": "failed",
+            "error": f"Dependency discovery failed: {e}",
+        }
+    tested = [name for name in tested if name not in failures]
+
+    # Packages under test are only installed for the others requiring them
+    install_list = [
+        name
+        for name in dep_graph.GetInstallList()
+        if name != root
+        and (name not in tested or dep_graph.GetDependents(name) - {root})
+    ]
+    dep_map = dep_graph.GetDependencyMap()
+    cache_keys = dict()
+    if ARTIFACT_CACHE:
+        cache_keys = ARTIFACT_CACHE.keys(install_list, dep_map)
+    checkpoints = CHECKPOINTS.install_keys(install_list, dep_map)
+    test_checkpoints = {
+        name: test_checkpoint(
+            name,
+            [
+                checkpoints[dep]
+                for dep in dep_graph.GetDependencies(name) & set(install_list)
+            ],
+        )
+        for name in tested
+    }
+
+    prev_umask = os.umask(000)
+    try:
+        with TRACER.span("dependency install"), compiler_cache_phase(
+            "dependencies"
+        ):
+            install_deps(install_list, dep_map, JOBS, cache_keys, checkpoints)
+    except Exception as e:
+        for name in tested:
+            results[name] = {
+                "result": "failed",
+                "error": f"Dependency install failed: {e}",
+            }
+        tested = []
+        traceback.print_exc()
+
+    os.makedirs(LOGS.path, exist_ok=True)
+    context = multiprocessing.get_context("fork")
+    with concurrent.futures.ProcessPoolExecutor(
+        max_workers=JOBS if JOBSERVER else 1, mp_context=context
+    ) as executor:
+        futures = {
+            executor.submit(
+                test_batch_package,
+                name,
+                test_checkpoints[name],
+                os.path.join(LOGS.path, name + ".log"),
+                prev_umask,
+                # The install its dependents build against has to stay
+                name not in install_list,
+            ): name
+            for name in tested
+        }
+        for future in concurrent.futures.as_completed(futures):
+            name = futures[future]
+            try:
+                results[name] = future.result()
+            except Exception as e:
+                # e.g. the worker died, which fails its package only
+                results[name] = {"result": "error", "error": repr(e)}
+            print(f"{name}: {results[name]['result']}")
+    os.umask(prev_umask)
+
+    partial = f"{report}.{os.getpid()}.partial"
+    with open(partial, "w") as f:
+        json.dump({"packages": results}, f, indent=1, sort_keys=True)
+    os.replace(partial, report)
+
+    print("Unit test results:")
+    for name in names:
+        result = results[name]
+        print(
+            f"  {name:<40} {result['result']:<8}",
+            result.get("log") or result.get("error", ""),
+        )
+    passed = all(
+        r["result"] in ["passed", "skipped"] for r in results.values()
+    )
+    return 0 if passed else 1
 
 
 def find_file(filename, basedir):
@@ -1253,6 +4720,131 @@ def find_file(filename, basedir):
     return filepaths
 
 
+class JobWorker:
+    """
+    Long-running worker accepting unit test jobs over a Unix socket. Each job
+    runs in a process forked from the worker, so that it starts with the
+    modules imported, the toolchain probed and the dependency installs of
+    earlier jobs in place, while its own state stays isolated.
+    """
+
+    # Record of the latest install of each dependency into the prefix by the
+    # worker's jobs, valid for as long as the container lives
+    INSTALLS = "/tmp/unit-test-installs.json"
+
+    # Size of the job's exit status, which follows the job's output
+    STATUS_SIZE = 4
+
+    def __init__(self, path):
+        """
+        Create new JobWorker.
+
+        Parameter descriptions:
+        path               Path of the Unix socket to accept jobs on
+        """
+        self.path = path
+
+    def warm(self, cache_dir):
+        """
+        Probe the toolchain, so that the jobs find the results.
+
+        Parameter descriptions:
+        cache_dir          Directory the probe results are kept in
+        """
+        ToolchainProbes(os.path.join(cache_dir, "toolchain")).probe_all()
+
+    def serve(self, parser):
+        """
+        Run the jobs one at a time. Only returns in the forked process of a
+        job, with the job's arguments.
+
+        Parameter descriptions:
+        parser             The argument parser of the job requests
+        """
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(self.path)
+        listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        # Only the worker's user may submit jobs
+        umask = os.umask(0o177)
+        try:
+            listener.bind(self.path)
+        finally:
+            os.umask(umask)
+        listener.listen()
+        print("Accepting jobs on", self.path)
+        while True:
+            conn, _ = listener.accept()
+            # The job's commands only get the connection as their output
+            conn.set_inheritable(False)
+            with conn:
+                try:
+                    with conn.makefile("rb") as f:
+                        job = json.loads(f.readline())
+                except ValueError:
+                    continue
+                print("Running job:", " ".join(job["argv"]))
+                pid = os.fork()
+                if pid == 0:
+                    listener.close()
+                    return self._start(parser, conn, job)
+                _, status = os.waitpid(pid, 0)
+                code = os.waitstatus_to_exitcode(status)
+                print("Job exited with status", code)
+                with contextlib.suppress(OSError):
+                    conn.sendall(
+                        code.to_bytes(
+                            JobWorker.STATUS_SIZE, "big", signed=True
+                        )
+                    )
+                    # Background processes left by the job may still hold
+                    # its output open, which mustn't keep the submitter
+                    # waiting for the end of the stream
+                    conn.shutdown(socket.SHUT_RDWR)
+
+    def _start(self, parser, conn, job):
+        os.dup2(conn.fileno(), sys.stdout.fileno())
+        os.dup2(conn.fileno(), sys.stderr.fileno())
+        conn.close()
+        sys.stdout.reconfigure(line_buffering=True)
+        os.chdir(job["cwd"])
+        args = parser.parse_args(job["argv"])
+        if args.WORKER or args.SUBMIT:
+            parser.error("jobs can't start or submit to workers")
+        return args
+
+    @staticmethod
+    def submit(path, argv):
+        """
+        Run a job on the worker, forwarding its output. Return the job's exit
+        status.
+
+        Parameter descriptions:
+        path               Path of the worker's Unix socket
+        argv               Arguments of the job
+        """
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.connect(path)
+            job = {"argv": argv, "cwd": os.getcwd()}
+            sock.sendall(json.dumps(job).encode("utf-8") + b"\n")
+            # The output may hold any bytes, so the status is told apart by
+            # its position at the end of the stream
+            pending = b""
+            while True:
+                data = sock.recv(65536)
+                if not data:
+                    break
+                pending += data
+                output = pending[: -JobWorker.STATUS_SIZE]
+                pending = pending[len(output) :]
+                sys.stdout.buffer.write(output)
+                sys.stdout.flush()
+        if len(pending) < JobWorker.STATUS_SIZE:
+            raise Exception("The worker didn't report the job's status")
+        code = int.from_bytes(pending, "big", signed=True)
+        # Jobs killed by a signal exit like they would from a shell
+        return code if code >= 0 else 128 - code
+
+
 if __name__ == "__main__":
     # CONFIGURE_FLAGS = [GIT REPO]:[CONFIGURE FLAGS]
     CONFIGURE_FLAGS = {
@@ -1326,9 +4918,29 @@ if __name__ == "__main__":
         "-p",
         "--package",
         dest="PACKAGE",
-        required=True,
+        required=False,
         help="OpenBMC package to be unit tested",
     )
+    parser.add_argument(
+        "--packages",
+        dest="PACKAGES",
+        nargs="+",
+        required=False,
+        default=[],
+        help=(
+            "Further packages to unit test in the same run, installing the"
+            " dependencies they share once"
+        ),
+    )
+    parser.add_argument(
+        "--batch-report",
+        dest="BATCH_REPORT",
+        required=False,
+        help=(
+            "Path of the JSON report of the packages' results when testing"
+            " several (default: WORKSPACE/unit-test-report.json)"
+        ),
+    )
     parser.add_argument(
         "-t",
         "--test-only",
@@ -1363,6 +4975,241 @@ if __name__ == "__main__":
     parser.add_argument(
         "-r", "--repeat", help="Repeat tests N times", type=int, default=1
     )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        dest="JOBS",
+        type=int,
+        required=False,
+        default=min(4, available_cpus()),
+        help="Number of dependencies to fetch and build concurrently",
+    )
+    parser.add_argument(
+        "--git-url",
+        dest="GIT_URL",
+        required=False,
+        default="https://gerrit.openbmc.org/openbmc/",
+        help="Base URL (or directory) to clone dependencies from",
+    )
+    parser.add_argument(
+        "--clone-depth",
+        dest="CLONE_DEPTH",
+        type=int,
+        required=False,
+        default=0,
+        help="Shallow clone dependencies to this depth (default: blobless)",
+    )
+    parser.add_argument(
+        "--git-mirror",
+        dest="GIT_MIRROR",
+        required=False,
+        help="Directory of bare repository mirrors to clone dependencies from",
+    )
+    parser.add_argument(
+        "--offline",
+        dest="OFFLINE",
+        action="store_true",
+        required=False,
+        default=False,
+        help=(
+            "Don't access the network: use the --git-mirror repositories"
+            " without refreshing them, and fail on meson subprojects which"
+            " are needed but missing from the wrap cache"
+        ),
+    )
+    parser.add_argument(
+        "--cache-dir",
+        dest="CACHE_DIR",
+        required=False,
+        help=(
+            "Directory to keep caches in between runs"
+            " (default: WORKSPACE/.unit-test-cache)"
+        ),
+    )
+    parser.add_argument(
+        "--artifact-cache-size",
+        dest="ARTIFACT_CACHE_SIZE",
+        type=int,
+        required=False,
+        default=4096,
+        help="Size limit of the dependency artifact cache in MiB, 0 disables",
+    )
+    parser.add_argument(
+        "--wrap-cache",
+        dest="WRAP_CACHE",
+        required=False,
+        help=(
+            "Directory to keep the sources of meson wrap subprojects in, e.g."
+            " one seeded for the host or image (default: <cache dir>/wraps)"
+        ),
+    )
+    parser.add_argument(
+        "--no-wrap-cache",
+        dest="USE_WRAP_CACHE",
+        action="store_false",
+        required=False,
+        help="Leave the download of meson wrap subprojects to meson",
+    )
+    parser.add_argument(
+        "--ccache-size",
+        dest="CCACHE_SIZE",
+        type=int,
+        required=False,
+        default=5120,
+        help="Size limit of the compiler cache in MiB, 0 disables",
+    )
+    parser.add_argument(
+        "--order-tests",
+        dest="ORDER_TESTS",
+        action="store_true",
+        required=False,
+        default=False,
+        help=(
+            "Run the longest meson tests first and derive their timeouts from"
+            " the test history, by rewriting meson's private test data"
+        ),
+    )
+    parser.add_argument(
+        "--incremental-clang-tidy",
+        dest="INCREMENTAL_CLANG_TIDY",
+        action="store_true",
+        required=False,
+        default=False,
+        help=(
+            "Only run clang-tidy on translation units affected by the change"
+            " and not previously found clean"
+        ),
+    )
+    parser.add_argument(
+        "--trace",
+        dest="TRACE",
+        required=False,
+        help="Write a Chrome trace of the run's phases and commands to TRACE",
+    )
+    parser.add_argument(
+        "--log-dir",
+        dest="LOG_DIR",
+        required=False,
+        help=(
+            "Directory to write the compressed output of each phase to"
+            " (default: WORKSPACE/unit-test-logs)"
+        ),
+    )
+    parser.add_argument(
+        "--log-lines",
+        dest="LOG_LINES",
+        type=int,
+        required=False,
+        default=0,
+        help=(
+            "Capture the output of each phase in a compressed log instead of"
+            " streaming it to the console, printing only the last LOG_LINES"
+            " lines of a failed command or test (default: 0, no capture)"
+        ),
+    )
+    parser.add_argument(
+        "--no-jobserver",
+        dest="JOBSERVER",
+        action="store_false",
+        required=False,
+        default=True,
+        help=(
+            "Don't share job slots between make, ninja and meson test through"
+            " a jobserver sized from the container's CPU and memory limits"
+        ),
+    )
+    parser.add_argument(
+        "--affected-tests",
+        dest="AFFECTED_TESTS",
+        action="store_true",
+        required=False,
+        default=False,
+        help=(
+            "Only run the meson tests depending on the files changed by the"
+            " commit under test, or all of them if build files changed"
+        ),
+    )
+    parser.add_argument(
+        "--reuse-test-results",
+        dest="REUSE_TEST_RESULTS",
+        action="store_true",
+        required=False,
+        default=False,
+        help=(
+            "Skip meson tests which passed before with identical inputs,"
+            " unless --repeat is given. The inputs don't cover files which"
+            " tests read undeclared, e.g. data files in the source tree"
+        ),
+    )
+    parser.add_argument(
+        "--dep-index",
+        dest="DEP_INDEX",
+        required=False,
+        help=(
+            "Path of the precomputed dependency index"
+            " (default: <cache dir>/dep-index.json)"
+        ),
+    )
+    parser.add_argument(
+        "--update-dep-index",
+        dest="UPDATE_DEP_INDEX",
+        action="store_true",
+        required=False,
+        default=False,
+        help=(
+            "Update the dependency index for the branch from the repositories"
+            " and exit instead of testing a package"
+        ),
+    )
+    parser.add_argument(
+        "--repositories",
+        dest="REPOSITORIES",
+        required=False,
+        help=(
+            "File listing the repository URLs to index, one per line"
+            " (default: every repository in the git mirror)"
+        ),
+    )
+    parser.add_argument(
+        "--worker",
+        dest="WORKER",
+        required=False,
+        help=(
+            "Keep running, accepting jobs with the arguments of unit-test.py"
+            " on the Unix socket WORKER, e.g. from --submit"
+        ),
+    )
+    parser.add_argument(
+        "--submit",
+        dest="SUBMIT",
+        required=False,
+        help=(
+            "Run the job with the remaining arguments on the worker accepting"
+            " jobs on the Unix socket SUBMIT"
+        ),
+    )
+    parser.add_argument(
+        "--resume",
+        dest="RESUME",
+        action="store_true",
+        required=False,
+        default=False,
+        help=(
+            "Skip the phases which completed in the previous run with"
+            " unchanged inputs, e.g. the dependency installs"
+        ),
+    )
+    parser.add_argument(
+        "--single-pass",
+        dest="SINGLE_PASS",
+        action="store_true",
+        required=False,
+        default=False,
+        help=(
+            "Merge compatible test instrumentation into fewer test runs, e.g."
+            " collect coverage during the plain test run"
+        ),
+    )
     parser.add_argument(
         "-b",
         "--branch",
@@ -1380,40 +5227,145 @@ if __name__ == "__main__":
         help="Whether or not to run format code",
     )
     args = parser.parse_args(sys.argv[1:])
+    if args.SUBMIT:
+        argv = sys.argv[1:]
+        index = next(
+            i for i, arg in enumerate(argv) if arg.startswith("--submit")
+        )
+        del argv[index : index + (1 if "=" in argv[index] else 2)]
+        sys.exit(JobWorker.submit(args.SUBMIT, argv))
+    PREFIX_INSTALLS = None
+    if args.WORKER:
+        worker = JobWorker(args.WORKER)
+        worker.warm(
+            args.CACHE_DIR or os.path.join(args.WORKSPACE, ".unit-test-cache")
+        )
+        # Returns in the forked process of a job, with the job's arguments
+        args = worker.serve(parser)
+        PREFIX_INSTALLS = Checkpoints(JobWorker.INSTALLS, True)
+    if args.OFFLINE and not args.GIT_MIRROR:
+        parser.error("--offline requires --git-mirror")
+    if not args.PACKAGE and not args.UPDATE_DEP_INDEX:
+        parser.error("the following arguments are required: -p/--package")
+    if args.UPDATE_DEP_INDEX and not (args.REPOSITORIES or args.GIT_MIRROR):
+        parser.error(
+            "--update-dep-index requires --repositories or --git-mirror"
+        )
     WORKSPACE = args.WORKSPACE
     UNIT_TEST_PKG = args.PACKAGE
     TEST_ONLY = args.TEST_ONLY
+    SINGLE_PASS = args.SINGLE_PASS
+    AFFECTED_TESTS = args.AFFECTED_TESTS
     INTEGRATION_TEST = args.INTEGRATION_TEST
     BRANCH = args.BRANCH
     FORMAT_CODE = args.FORMAT
+    TRACER = Tracer(args.TRACE)
+    atexit.register(TRACER.finish)
+    LOGS = LogCapture(
+        args.LOG_DIR or os.path.join(WORKSPACE, "unit-test-logs"),
+        args.LOG_LINES,
+    )
+    if not args.RESUME:
+        # Only a resumed run continues the logs of the one before
+        LOGS.clear()
+    JOBS = args.JOBS
+    GIT_URL = args.GIT_URL.rstrip("/") + "/"
+    CLONE_DEPTH = args.CLONE_DEPTH
+    GIT_MIRROR = args.GIT_MIRROR
+    OFFLINE = args.OFFLINE
+    # Serializes installation into the shared prefix between the dependency
+    # builds, which are forked from this process.
+    INSTALL_LOCK = multiprocessing.get_context("fork").Lock()
+    CACHE_DIR = args.CACHE_DIR or os.path.join(WORKSPACE, ".unit-test-cache")
+    WRAP_CACHE = None
+    if args.USE_WRAP_CACHE:
+        WRAP_CACHE = WrapCache(
+            args.WRAP_CACHE or os.path.join(CACHE_DIR, "wraps"), OFFLINE
+        )
+    DEP_SCAN_CACHE = DepScanCache(os.path.join(CACHE_DIR, "depscan"))
+    TOOLCHAIN = ToolchainProbes(os.path.join(CACHE_DIR, "toolchain"))
+    INCREMENTAL_CLANG_TIDY = args.INCREMENTAL_CLANG_TIDY
+    ORDER_TESTS = args.ORDER_TESTS
+    CLANG_TIDY_CACHE = ClangTidyCache(os.path.join(CACHE_DIR, "clang-tidy"))
+    TEST_HISTORY = TestHistory(os.path.join(CACHE_DIR, "test-history"))
+    # Stress runs have to run the tests regardless of earlier results
+    TEST_RESULTS = None
+    if args.REUSE_TEST_RESULTS and args.repeat == 1:
+        TEST_RESULTS = TestResultCache(os.path.join(CACHE_DIR, "test-results"))
     if args.verbose:
 
         def printline(*line):
-            for arg in line:
-                print(arg, end=" ")
-            print()
+            # A single print() keeps lines from concurrent clones intact
+            print(*line)
 
     else:
 
         def printline(*line):
             pass
 
-    CODE_SCAN_DIR = os.path.join(WORKSPACE, UNIT_TEST_PKG)
+    JOBSERVER = None
+    if args.JOBSERVER and TOOLCHAIN.check("jobserver"):
+        JOBSERVER = JobServer()
+        atexit.register(JOBSERVER.close)
+        os.environ.update(JOBSERVER.environ())
+        # make takes its job slots from the jobserver, and the load average
+        # doesn't reflect the container's share of the host
+        make_parallel = ["make", "-O"]
+
+    CCACHE = None
+    if args.CCACHE_SIZE > 0 and TOOLCHAIN.check("ccache"):
+        CCACHE = CompilerCache(
+            os.path.join(CACHE_DIR, "ccache"), args.CCACHE_SIZE * 1024 * 1024
+        )
+        os.environ.update(CCACHE.environ())
+        atexit.register(CCACHE.report)
+    else:
+        # Meson would otherwise use ccache whenever it is installed
+        os.environ["CCACHE_DISABLE"] = "1"
 
-    # Run format-code.sh, which will in turn call any repo-level formatters.
-    if FORMAT_CODE:
-        check_call_cmd(
-            os.path.join(
-                WORKSPACE, "openbmc-build-scripts", "scripts", "format-code.sh"
-            ),
-            CODE_SCAN_DIR,
+    DEP_INDEX = DepIndex(
+        args.DEP_INDEX or os.path.join(CACHE_DIR, "dep-index.json")
+    )
+    if args.UPDATE_DEP_INDEX:
+        if args.REPOSITORIES:
+            with open(args.REPOSITORIES, "r") as f:
+                urls = [line.strip() for line in f if line.strip()]
+        else:
+            urls = [
+                os.path.join(GIT_MIRROR, d)
+                for d in sorted(os.listdir(GIT_MIRROR))
+                if d.endswith(".git")
+            ]
+        repos = {
+            os.path.basename(url.rstrip("/")).removesuffix(".git"): url
+            for url in urls
+        }
+        update_dep_index(DEP_INDEX, repos, BRANCH, JOBS)
+        sys.exit(0)
+
+    CODE_SCAN_DIR = os.path.join(WORKSPACE, UNIT_TEST_PKG)
+    CHECKPOINTS = Checkpoints(
+        os.path.join(WORKSPACE, ".unit-test-checkpoints.json"), args.RESUME
+    )
+    ARTIFACT_CACHE = None
+    if args.ARTIFACT_CACHE_SIZE > 0:
+        ARTIFACT_CACHE = ArtifactCache(
+            os.path.join(CACHE_DIR, "artifacts"),
+            args.ARTIFACT_CACHE_SIZE * 1024 * 1024,
         )
 
-        # Check to see if any files changed
-        check_call_cmd(
-            "git", "-C", CODE_SCAN_DIR, "--no-pager", "diff", "--exit-code"
+    if args.PACKAGES:
+        sys.exit(
+            test_batch(
+                [UNIT_TEST_PKG]
+                + [p for p in args.PACKAGES if p != UNIT_TEST_PKG],
+                args.BATCH_REPORT
+                or os.path.join(WORKSPACE, "unit-test-report.json"),
+            )
         )
 
+    format_code(UNIT_TEST_PKG)
+
     # Check if this repo has a supported make infrastructure
     pkg = Package(UNIT_TEST_PKG, CODE_SCAN_DIR)
     if not pkg.build_system():
@@ -1422,38 +5374,38 @@ if __name__ == "__main__":
 
     prev_umask = os.umask(000)
 
-    # Determine dependencies and add them
-    dep_added = dict()
-    dep_added[UNIT_TEST_PKG] = False
-
-    # Create dependency tree
-    dep_tree = DepTree(UNIT_TEST_PKG)
-    build_dep_tree(UNIT_TEST_PKG, CODE_SCAN_DIR, dep_added, dep_tree, BRANCH)
-
-    # Reorder Dependency Tree
-    for pkg_name, regex_str in DEPENDENCIES_REGEX.items():
-        dep_tree.ReorderDeps(pkg_name, regex_str)
-    if args.verbose:
-        dep_tree.PrintTree()
+    # Determine dependencies and create the dependency graph
+    dep_graph = DepGraph(UNIT_TEST_PKG)
+    discover_dependencies(dep_graph, [UNIT_TEST_PKG])
 
-    install_list = dep_tree.GetInstallList()
+    install_list = dep_graph.GetInstallList()
 
     # We don't want to treat our package as a dependency
     install_list.remove(UNIT_TEST_PKG)
 
+    dep_map = dep_graph.GetDependencyMap()
+
+    cache_keys = dict()
+    if ARTIFACT_CACHE:
+        cache_keys = ARTIFACT_CACHE.keys(install_list, dep_map)
+
+    checkpoints = CHECKPOINTS.install_keys(install_list, dep_map)
+    checkpoints[UNIT_TEST_PKG] = test_checkpoint(
+        UNIT_TEST_PKG, checkpoints.values()
+    )
+
     # Install reordered dependencies
-    for dep in install_list:
-        build_and_install(dep, False)
+    with TRACER.span("dependency install"), compiler_cache_phase(
+        "dependencies"
+    ):
+        install_deps(install_list, dep_map, JOBS, cache_keys, checkpoints)
 
     # Run package unit tests
-    build_and_install(UNIT_TEST_PKG, True)
+    with TRACER.span("unit test"):
+        build_and_install(
+            UNIT_TEST_PKG, True, checkpoint=checkpoints[UNIT_TEST_PKG]
+        )
 
     os.umask(prev_umask)
 
-    # Run any custom CI scripts the repo has, of which there can be
-    # multiple of and anywhere in the repository.
-    ci_scripts = find_file(["run-ci.sh", "run-ci"], CODE_SCAN_DIR)
-    if ci_scripts:
-        os.chdir(CODE_SCAN_DIR)
-        for ci_script in ci_scripts:
-            check_call_cmd(ci_script)
+    run_ci_scripts(CODE_SCAN_DIR)